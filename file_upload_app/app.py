@@ -1,24 +1,692 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, g, render_template, request, jsonify, send_file, session, url_for
 from flask_sqlalchemy import SQLAlchemy
+import click
+import collections
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta, timezone
+from urllib.parse import quote, unquote
+import cProfile
+import hashlib
+import hmac
+import json
+import math
+import mimetypes
+import multiprocessing
 import os
+import re
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DBAPIError, IntegrityError
+from sqlalchemy.orm import Session
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+import metrics
+import thumbnails
+from archive import stream_zip
+from storage import (
+    BlobStore,
+    UploadTooLarge,
+    append_stream,
+    compress_file,
+    hash_file,
+    open_stored,
+    receive_stream,
+    move_aside,
+    try_lock,
+    unlink_many,
+)
 
 app = Flask(__name__)
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///database.db"
-app.config["UPLOAD_FOLDER"] = os.path.join("static", "uploads")
-app.config["MAX_CONTENT_LENGTH"] = 500 * 1024  # 500 KB limit
+
+def load_secret_key():
+    """Session signing key shared by every worker, created once in the instance folder"""
+    path = os.path.join(app.instance_path, "secret_key")
+    os.makedirs(app.instance_path, exist_ok=True)
+    if not os.path.exists(path):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wb") as f:
+            f.write(os.urandom(32))
+        try:
+            os.link(tmp_path, path)  # atomic; another worker may have won the race
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp_path)
+    with open(path, "rb") as f:
+        return f.read()
+
+app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL", "sqlite:///database.db")
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+    "pool_pre_ping": True,
+    "pool_recycle": 3600,
+}
+# Applied to every new SQLite connection; ignored for other databases
+app.config["SQLITE_PRAGMAS"] = {
+    "journal_mode": "WAL",  # readers no longer block on the writer
+    "synchronous": "NORMAL",  # durable at checkpoints; safe with WAL
+    "busy_timeout": 5000,  # ms to wait for the write lock instead of failing
+    "mmap_size": 256 * 1024 * 1024,
+    "foreign_keys": "ON",
+}
+# Documents belong to the browser session that uploaded them (signed cookie)
+app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY") or load_secret_key()
+app.config["SESSION_COOKIE_SAMESITE"] = "Lax"
+app.config["PERMANENT_SESSION_LIFETIME"] = timedelta(days=30)
+app.config["UPLOAD_FOLDER"] = os.environ.get("UPLOAD_FOLDER", os.path.join("static", "uploads"))
+app.config["UPLOAD_FANOUT_LEVELS"] = 2  # hash-prefix directory levels under UPLOAD_FOLDER
+app.config["MAX_CONTENT_LENGTH"] = 64 * 1024  # default for requests without their own limit
+# Per-file size limits by upload mode; upload routes raise the request cap to match
+app.config["UPLOAD_LIMITS"] = {
+    "single": 500 * 1024,  # 500 KB limit
+    "batch": 500 * 1024,
+    "resumable": 100 * 1024 * 1024,
+}
+app.config["RESUMABLE_CHUNK_LIMIT"] = 4 * 1024 * 1024  # largest PATCH body
+app.config["UPLOAD_SESSION_TTL"] = timedelta(hours=24)
+app.config["MAX_BATCH_FILES"] = 10
+app.config["MAX_HASH_LOOKUP"] = 1000  # checksums per /lookup_hashes request
+app.config["EXPORT_BATCH"] = 500  # documents looked up per query while streaming /export
+app.config["UPLOAD_CHUNK_SIZE"] = 64 * 1024  # bytes read per step while streaming
+app.config["UPLOAD_SPOOL_SIZE"] = 512 * 1024  # uploads up to this size are hashed in memory
+# Gzip compressible uploads on write; already-compressed formats are stored as-is
+app.config["COMPRESS_UPLOADS"] = os.environ.get("COMPRESS_UPLOADS") == "1"
+app.config["COMPRESS_LEVEL"] = 6
+# Downloads: Flask's USE_X_SENDFILE hands files to Apache/lighttpd via X-Sendfile;
+# DOWNLOAD_ACCEL_REDIRECT is the nginx "internal" location that maps to UPLOAD_FOLDER
+app.config["USE_X_SENDFILE"] = False
+app.config["DOWNLOAD_ACCEL_REDIRECT"] = None  # e.g. "/protected-uploads/"
+# Send "X-Profile: 1" to dump a cProfile of that request into PROFILE_DIR
+app.config["PROFILING_ENABLED"] = os.environ.get("PROFILING_ENABLED") == "1"
+app.config["PROFILE_DIR"] = os.environ.get("PROFILE_DIR", "profiles")
+# Shared by every server process so /metrics reports all of them (set by gunicorn.conf.py)
+app.config["METRICS_DIR"] = os.environ.get("METRICS_DIR")
+# Thumbnail and preview images for uploaded pictures (needs Pillow). Rendering
+# runs in a per-process pool so resizing never holds a request thread or the GIL
+app.config["PREVIEWS_ENABLED"] = os.environ.get("PREVIEWS_ENABLED", "1") == "1"
+app.config["PREVIEW_PROCESSES"] = 2
+app.config["PREVIEW_TIMEOUT"] = 60  # seconds before a render is retried as a failed job
+app.config["PREVIEW_MAX_AGE"] = 365 * 24 * 3600  # derivatives are keyed by content, so never stale
+# /events: one poller thread per process fans new Event rows out to its subscribers.
+# Under the default gevent workers each subscriber is a greenlet; under gthread it
+# holds a thread, so gunicorn.conf.py caps the count per process to match
+app.config["EVENTS_MAX_SUBSCRIBERS"] = int(os.environ.get("EVENTS_MAX_SUBSCRIBERS", 1000))
+app.config["EVENTS_POLL_INTERVAL"] = 0.5  # seconds; commits in this process wake it at once
+app.config["EVENTS_HEARTBEAT"] = 15  # seconds between keepalive comments
+app.config["EVENTS_STREAM_SECONDS"] = 300  # streams end after this; clients reconnect and resume
+app.config["EVENTS_BUFFER"] = 1000  # recent events kept in memory for subscribers
+app.config["EVENTS_RETENTION"] = timedelta(hours=1)  # older events are pruned
+app.config["JOB_WORKERS"] = 2  # background worker threads per process; 0 disables them
+app.config["JOB_POLL_INTERVAL"] = 1.0  # seconds between checks for due jobs
+app.config["JOB_MAX_ATTEMPTS"] = 5
+app.config["UNLINK_BATCH"] = 50  # freed blobs claimed per write transaction by the unlink job
+# A running job whose claim is older than this is taken to belong to a worker
+# that exited (max_requests, timeout kill, HUP) and is run again; keep it well
+# above the longest job (PREVIEW_TIMEOUT)
+app.config["JOB_LEASE"] = timedelta(minutes=10)
+# Admission control for upload routes, applied before any body bytes are read:
+# per-client token buckets and a cap on uploads in flight, both shared by every
+# worker process through the database, and quotas checked against usage
+# counters kept up to date on every write. 0 disables each.
+app.config["UPLOAD_RATE"] = float(os.environ.get("UPLOAD_RATE", 5))  # uploads/second per client
+app.config["UPLOAD_BURST"] = int(os.environ.get("UPLOAD_BURST", 20))  # bucket size
+app.config["MAX_UPLOADS_IN_FLIGHT"] = int(os.environ.get("MAX_UPLOADS_IN_FLIGHT", 16))  # whole server
+app.config["ADMISSION_RETRY_AFTER"] = 2  # seconds, sent with 503 when at the in-flight cap
+app.config["OWNER_QUOTA_BYTES"] = int(os.environ.get("OWNER_QUOTA_BYTES", 100 * 1024 * 1024))  # per session
+app.config["STORAGE_QUOTA_BYTES"] = int(os.environ.get("STORAGE_QUOTA_BYTES", 0))  # bytes on disk, all blobs
+app.config["PROXY_HOPS"] = int(os.environ.get("PROXY_HOPS", 0))  # trusted X-Forwarded-For hops
+# Documents stored before owner scoping belong to no one; whoever POSTs this
+# token to /claim_legacy adopts them all. Unset, the route does not exist.
+app.config["LEGACY_CLAIM_TOKEN"] = os.environ.get("LEGACY_CLAIM_TOKEN")
+# Reconciliation checks the upload folder against the tables in small steps,
+# from `flask reconcile` or as a self-rescheduling background job
+app.config["RECONCILE_GRACE"] = timedelta(hours=1)  # younger unreferenced files may be mid-upload
+app.config["RECONCILE_BATCH"] = 1000  # root files or document ids checked per step
+app.config["RECONCILE_INTERVAL"] = 2.0  # seconds between background steps
+# Seconds between background passes; RECONCILE_PERIOD=0 (or empty) disables them
+app.config["RECONCILE_PERIOD"] = timedelta(seconds=float(os.environ.get("RECONCILE_PERIOD", 86400) or 0)) or None
+app.config["RECONCILE_REPAIR"] = os.environ.get("RECONCILE_REPAIR") == "1"  # else background passes only report
+app.config["RECONCILE_CURSOR"] = os.path.join(app.instance_path, "reconcile-cursor.json")  # CLI resume point
 
 db = SQLAlchemy(app)
 
+if app.config["METRICS_DIR"]:
+    metrics.share_values(app.config["METRICS_DIR"])
+
+if app.config["PROXY_HOPS"]:
+    # Rate limits key on the client address, which a reverse proxy would otherwise hide
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config["PROXY_HOPS"])
+
+REQUEST_SECONDS = metrics.Histogram(
+    "http_request_duration_seconds", "Request latency by route.", ["method", "route", "status"])
+REQUESTS_IN_FLIGHT = metrics.Gauge(
+    "http_requests_in_flight", "Requests currently being handled.", ["route"])
+UPLOAD_BYTES = metrics.Counter(
+    "upload_bytes_total", "Bytes received by upload routes.", ["mode"])
+UPLOAD_THROUGHPUT = metrics.Histogram(
+    "upload_throughput_bytes_per_second", "Receive rate of individual uploads.", ["mode"],
+    buckets=(64e3, 256e3, 1e6, 4e6, 16e6, 64e6, 256e6, 1e9))
+DB_QUERY_SECONDS = metrics.Histogram(
+    "db_query_seconds", "Time spent executing SQL statements.", ["statement"])
+DB_COMMIT_SECONDS = metrics.Histogram(
+    "db_commit_seconds", "Time spent flushing and committing ORM sessions.")
+RECONCILE_FINDINGS = metrics.Counter(
+    "reconcile_findings_total", "Disk/database inconsistencies found by reconciliation.", ["kind"])
+UPLOADS_SHED = metrics.Counter(
+    "uploads_shed_total", "Uploads turned away before their body was read.", ["reason"])
+EVENT_SUBSCRIBERS = metrics.Gauge(
+    "event_subscribers", "Open /events streams in this process.")
+
 # -------------------------
 # Database Model
 # -------------------------
+def utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
 class Document(db.Model):
+    # Every per-caller query is "owner = ? [AND id > ?] ORDER BY id"
+    __table_args__ = (db.Index("ix_document_owner_id", "owner", "id"),)
+
     id = db.Column(db.Integer, primary_key=True)
+    owner = db.Column(db.String(32))  # session that uploaded it; see current_owner()
+    filename = db.Column(db.String(255), index=True)
+    status = db.Column(db.String(20), default="pending", index=True)  # pending/saved
+    size = db.Column(db.Integer)  # logical size
+    stored_size = db.Column(db.Integer)  # bytes on disk after compression
+    checksum = db.Column(db.String(64), index=True)  # sha256 hex of the content; key into Blob
+    upload_key = db.Column(db.String(64), index=True, unique=True)  # client's Idempotency-Key
+
+class Blob(db.Model):
+    """Stored file content, shared by every Document with the same checksum"""
+    sha256 = db.Column(db.String(64), primary_key=True)
+    size = db.Column(db.Integer)  # logical size
+    refcount = db.Column(db.Integer, default=0)  # number of Documents pointing here
+    encoding = db.Column(db.String(20), default="identity")  # identity/gzip on disk
+    stored_size = db.Column(db.Integer)  # bytes on disk
+    preview_status = db.Column(db.String(20))  # None until rendered, then ready/none
+
+class Counter(db.Model):
+    """Named integer counter, e.g. the version of the document listing"""
+    name = db.Column(db.String(64), primary_key=True)
+    value = db.Column(db.Integer, default=0, nullable=False)
+
+class RateBucket(db.Model):
+    """A client's upload token bucket, shared by every worker process"""
+    client = db.Column(db.String(64), primary_key=True)  # request.remote_addr
+    tokens = db.Column(db.Float, nullable=False)
+    refilled = db.Column(db.Float, nullable=False, index=True)  # epoch seconds of the last refill
+
+class UploadSession(db.Model):
+    """In-progress resumable upload; becomes a Document once finalized"""
+    id = db.Column(db.String(32), primary_key=True, default=lambda: uuid.uuid4().hex)
+    owner = db.Column(db.String(32), index=True)  # session that started it; see current_owner()
     filename = db.Column(db.String(255))
-    status = db.Column(db.String(20), default="pending")  # pending/saved
+    length = db.Column(db.Integer)  # declared total size, if known up front
+    offset = db.Column("upload_offset", db.Integer, default=0)  # bytes received so far
+    updated_at = db.Column(db.DateTime, default=utcnow)
+
+class Job(db.Model):
+    """Deferred side effect (file deletion, post-processing) for the worker pool"""
+    __table_args__ = (db.Index("ix_job_status_run_after", "status", "run_after"),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.JSON, default=dict)
+    status = db.Column(db.String(20), default="pending")  # pending/running/failed
+    attempts = db.Column(db.Integer, default=0)
+    run_after = db.Column(db.DateTime, default=utcnow)
+    claimed_at = db.Column(db.DateTime)  # when a worker last took it; see JOB_LEASE
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=utcnow)
+
+class Event(db.Model):
+    """Change to the document listing, streamed to /events subscribers
+
+    Written in the same transaction as the change it describes. Ids come
+    from the ``event_seq`` counter, whose row stays locked until that
+    transaction commits, so id order is commit order on any database and
+    subscribers can resume from any id.
+    """
+    # AUTOINCREMENT so SQLite never reuses ids once old events are pruned
+    __table_args__ = {"sqlite_autoincrement": True}
 
-with app.app_context():
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)  # created/updated/deleted
+    owner = db.Column(db.String(32))  # only this owner's subscribers receive it
+    payload = db.Column(db.JSON, default=dict)
+    created_at = db.Column(db.DateTime, default=utcnow, index=True)
+
+@event.listens_for(Engine, "connect")
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in app.config["SQLITE_PRAGMAS"].items():
+        cursor.execute(f"PRAGMA {name}={value}")
+    cursor.close()
+
+def dispose_engine_after_fork():
+    """Forked workers must not reuse connections opened by the parent"""
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+os.register_at_fork(after_in_child=dispose_engine_after_fork)
+
+def upgrade_schema():
+    """Bring an existing database up to the current models in place
+
+    Creates missing tables, then adds columns and indexes introduced after a
+    table was first created. Safe to run repeatedly.
+    """
     db.create_all()
+    inspector = db.inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {c["name"] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(db.engine.dialect)}"
+            db.session.execute(db.text(ddl))
+        for index in table.indexes:
+            index.create(db.session.connection(), checkfirst=True)
+    db.session.commit()
+
+@app.cli.command("upgrade-db")
+def upgrade_db_command():
+    """Upgrade the configured database schema in place."""
+    upgrade_schema()
+    print(f"Database schema is up to date ({db.engine.url.render_as_string()})")
+
+# -------------------------
+# Helpers
+# -------------------------
+def clean_filename(name):
+    """The last component of a client-supplied name; "" if nothing usable is left
+
+    Names are joined onto UPLOAD_FOLDER for files stored by name and written
+    into archives, so no directory part may survive, in either separator.
+    """
+    name = os.path.basename((name or "").replace("\\", "/").replace("\0", "")).strip()
+    return "" if name in (".", "..") else name
+
+def upload_limit(mode):
+    return app.config["UPLOAD_LIMITS"][mode]
+
+def too_large_error(mode):
+    return f"File exceeds {upload_limit(mode) // 1024}KB limit"
+
+HEX_SHA256 = re.compile(r"[0-9a-f]{64}")
+
+def blob_store():
+    return BlobStore(app.config["UPLOAD_FOLDER"], app.config["UPLOAD_FANOUT_LEVELS"])
+
+def blob_path(checksum):
+    return blob_store().path(checksum)
+
+def derived_store():
+    """Thumbnails and previews, sharded like the blobs they are rendered from"""
+    root = os.path.join(app.config["UPLOAD_FOLDER"], ".derived")
+    return BlobStore(root, app.config["UPLOAD_FANOUT_LEVELS"])
+
+def derived_base(checksum):
+    """Content-addressed stem that a blob's thumbnail and preview files hang off"""
+    return derived_store().path(checksum)
+
+def blob_files(checksum, preview_status):
+    """Every file on disk belonging to a blob: its content plus any derivatives"""
+    paths = [blob_path(checksum)]
+    if preview_status == "ready":
+        base = derived_base(checksum)
+        paths += [thumbnails.derivative_path(base, variant) for variant in thumbnails.VARIANTS]
+    return paths
+
+def legacy_path(doc):
+    """Where files stored before content addressing live"""
+    return blob_store().legacy_path(doc.filename)
+
+def stored_path(doc):
+    """Path of a document's bytes, whether content-addressed or stored by name"""
+    if doc.checksum:
+        path = blob_path(doc.checksum)
+        if os.path.exists(path):
+            return path
+    return legacy_path(doc)
+
+def run_blocking(fn, *args):
+    """Call ``fn`` on a real thread when running under gevent workers
+
+    Long CPU or disk work (hashing or compressing a large file) would
+    otherwise stall every other connection of the worker. A plain call
+    anywhere else.
+    """
+    if "gevent" in sys.modules:
+        from gevent import get_hub, monkey
+        if monkey.is_module_patched("threading"):
+            return get_hub().threadpool.apply(fn, args)
+    return fn(*args)
+
+def receive_upload(stream, mode):
+    """Stream an upload into memory or a temp file, enforcing the size cap as it goes"""
+    start = time.perf_counter()
+    staged = receive_stream(
+        stream,
+        app.config["UPLOAD_FOLDER"],
+        upload_limit(mode),
+        app.config["UPLOAD_CHUNK_SIZE"],
+        app.config["UPLOAD_SPOOL_SIZE"],
+        app.config["COMPRESS_LEVEL"] if app.config["COMPRESS_UPLOADS"] else None,
+    )
+    record_upload(mode, staged.size, time.perf_counter() - start)
+    return staged
+
+def record_upload(mode, size, seconds):
+    UPLOAD_BYTES.inc(size, mode=mode)
+    if seconds > 0:
+        UPLOAD_THROUGHPUT.observe(size / seconds, mode=mode)
+
+def add_blob_ref(checksum, size, count=1, encoding="identity", stored_size=None):
+    """Count more Documents against a blob, creating its row if needed
+
+    Returns True if this created the row.
+    """
+    bump = db.update(Blob).where(Blob.sha256 == checksum).values(refcount=Blob.refcount + count)
+    if db.session.execute(bump).rowcount:
+        return False
+    stored_size = size if stored_size is None else stored_size
+    try:
+        with db.session.begin_nested():
+            db.session.add(Blob(sha256=checksum, size=size, refcount=count, encoding=encoding,
+                                stored_size=stored_size))
+    except IntegrityError:
+        # Another request created the row first
+        db.session.execute(bump)
+        return False
+    incr_counter("stored_bytes", stored_size or 0)
+    return True
+
+def set_blob_storage(checksum, encoding, stored_size):
+    """Record how a blob's file was just written, keeping ``stored_bytes`` in step"""
+    previous = blob_stored_size(checksum, 0)
+    db.session.execute(
+        db.update(Blob).where(Blob.sha256 == checksum).values(encoding=encoding, stored_size=stored_size)
+    )
+    incr_counter("stored_bytes", stored_size - previous)
+
+def delete_blobs(*conditions):
+    """Delete the Blob rows matching ``conditions``
+
+    Returns ``{checksum: preview_status}`` for them, for :func:`unlink_later`
+    once the transaction commits.
+    """
+    freed = db.session.execute(
+        db.select(Blob.sha256, Blob.stored_size, Blob.preview_status).where(*conditions)
+    ).all()
+    if not freed:
+        return {}
+    db.session.execute(db.delete(Blob).where(*conditions).execution_options(synchronize_session=False))
+    incr_counter("stored_bytes", -sum(row.stored_size or 0 for row in freed))
+    return {row.sha256: row.preview_status for row in freed}
+
+def release_blob(doc):
+    """Drop one reference to a document's content
+
+    Returns ``(checksums, paths)`` to unlink once the transaction commits,
+    both empty while other documents still share the content.
+    """
+    if doc.checksum:
+        drop = db.update(Blob).where(Blob.sha256 == doc.checksum).values(refcount=Blob.refcount - 1)
+        if db.session.execute(drop).rowcount:
+            return delete_blobs(Blob.sha256 == doc.checksum, Blob.refcount <= 0), []
+    return {}, [legacy_path(doc)]
+
+def release_documents(condition):
+    """Delete every Document matching ``condition`` with set-based statements
+
+    Blob reference counts are decremented in one UPDATE and exhausted blobs
+    removed in one DELETE; usage counters are charged per owner. Returns
+    ``(deleted_count, checksums, paths)``; the caller unlinks the freed blobs
+    and legacy files after committing.
+    """
+    matching = db.select(Document.checksum).where(condition)
+    has_blob = db.select(Blob.sha256).where(Blob.sha256 == Document.checksum).exists()
+
+    # Rows without a Blob predate content addressing and are stored by name
+    legacy = db.session.execute(
+        db.select(Document.filename).where(condition, ~has_blob)
+    ).scalars().all()
+
+    # Grouped once and joined (UPDATE ... FROM) rather than a count per blob, so
+    # the planner cannot end up rescanning the owner's rows for every blob
+    per_blob = (
+        db.select(Document.checksum, db.func.count().label("n"))
+        .where(condition)
+        .group_by(Document.checksum)
+        .subquery()
+    )
+    db.session.execute(
+        db.update(Blob)
+        .where(Blob.sha256 == per_blob.c.checksum)
+        .values(refcount=Blob.refcount - per_blob.c.n)
+        .execution_options(synchronize_session=False)
+    )
+    # Only look at the blobs just decremented, so the cost follows the matched rows
+    checksums = delete_blobs(Blob.sha256.in_(matching), Blob.refcount <= 0)
+    for owner, count, size in db.session.execute(
+        db.select(Document.owner, db.func.count(), db.func.coalesce(db.func.sum(Document.size), 0))
+        .where(condition)
+        .group_by(Document.owner)
+    ):
+        charge_usage(owner, -count, -size)
+    deleted = db.session.execute(
+        db.delete(Document).where(condition).execution_options(synchronize_session=False)
+    ).rowcount
+
+    paths = [blob_store().legacy_path(name) for name in set(legacy)]
+    return deleted, checksums, paths
+
+def unlink_later(checksums=(), paths=()):
+    """Queue deletion of freed blobs and other files once the current transaction commits
+
+    Blobs go by checksum, as returned by :func:`delete_blobs`, so the job can
+    leave alone content that has been stored again in the meantime, and only
+    looks for derivatives of blobs whose previews were rendered.
+    """
+    freed, paths = dict(checksums), list(paths)
+    checksums = list(freed)
+    for start in range(0, len(checksums), 1000):
+        batch = checksums[start:start + 1000]
+        enqueue_job("unlink", {"checksums": batch,
+                               "rendered": [c for c in batch if freed[c] == "ready"]})
+    for start in range(0, len(paths), 1000):
+        enqueue_job("unlink", {"paths": paths[start:start + 1000]})
+
+def put_blob(staged, filename):
+    """Store staged bytes unless the content already exists and count one more
+    reference to it; returns the stored size
+
+    The Blob row is claimed before the file is looked at: a file on disk
+    without a row may belong to released content whose unlink job has not
+    run yet, so it is overwritten rather than reused.
+    """
+    checksum = staged.sha256
+    created = add_blob_ref(checksum, staged.size, encoding=staged.encoding)
+    if not created and blob_store().touch(checksum):
+        staged.discard()
+        return blob_stored_size(checksum, staged.size)
+    blob_store().put_staged(staged, checksum)
+    set_blob_storage(checksum, staged.encoding, staged.stored_size)
+    queue_previews(checksum, filename)
+    return staged.stored_size
+
+def store_staged(staged, filename, owner):
+    """Create a Document for staged bytes, writing them only if the content is new"""
+    stored_size = put_blob(staged, filename)
+    doc = Document(filename=filename, size=staged.size, stored_size=stored_size,
+                   checksum=staged.sha256, owner=owner)
+    db.session.add(doc)
+    charge_usage(owner, 1, staged.size)
+    return doc
+
+def queue_previews(checksum, filename):
+    """Schedule thumbnail and preview rendering for newly stored image content"""
+    if app.config["PREVIEWS_ENABLED"] and thumbnails.available() and thumbnails.is_image(filename):
+        enqueue_job("previews", {"checksum": checksum})
+
+def preview_url(checksum, variant):
+    """Root-relative URL of a derivative; built the same way in requests and in jobs"""
+    adapter = app.url_map.bind("localhost", script_name=app.config["APPLICATION_ROOT"])
+    return adapter.build("get_preview", {"checksum": checksum, "variant": variant})
+
+def preview_urls(checksum, preview_status):
+    ready = preview_status == "ready"
+    return {name: preview_url(checksum, variant) if ready else None
+            for name, variant in PREVIEW_FIELDS.items()}
+
+def blob_stored_size(checksum, default):
+    stored = db.session.execute(db.select(Blob.stored_size).where(Blob.sha256 == checksum)).scalar()
+    return default if stored is None else stored
+
+def incr_counter(name, amount=1):
+    """Add to a named counter inside the current transaction"""
+    bump = db.update(Counter).where(Counter.name == name).values(value=Counter.value + amount)
+    if db.session.execute(bump).rowcount:
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.add(Counter(name=name, value=amount))
+    except IntegrityError:
+        db.session.execute(bump)
+
+def read_counter(name):
+    return db.session.execute(db.select(Counter.value).where(Counter.name == name)).scalar() or 0
+
+def touch_documents(owner):
+    """Invalidate an owner's cached /get_files listings; call before committing a change"""
+    incr_counter(f"documents:{owner}")
+
+def charge_usage(owner, files, size):
+    """Count documents added (positive) or removed (negative) against an owner's usage"""
+    if owner is None:
+        return  # documents from before owner scoping count against no one
+    incr_counter(f"usage_files:{owner}", files)
+    incr_counter(f"usage_bytes:{owner}", size)
+
+def over_quota(owner, size):
+    """``(message, status)`` if storing ``size`` more bytes would exceed a quota, else None
+
+    Read from the usage counters, so no scan is needed. Uploads running at
+    the same moment have not been counted yet, so a quota can be overshot by
+    what MAX_UPLOADS_IN_FLIGHT lets through at once.
+    """
+    quota = app.config["OWNER_QUOTA_BYTES"]
+    if quota and read_counter(f"usage_bytes:{owner}") + size > quota:
+        return f"Storage quota of {quota // 1024}KB exceeded", 413
+    limit = app.config["STORAGE_QUOTA_BYTES"]
+    if limit and read_counter("stored_bytes") + size > limit:
+        return "Server storage is full", 507
+    return None
+
+def quota_error(owner, size):
+    """The response for :func:`over_quota`, or None if the upload fits"""
+    problem = over_quota(owner, size)
+    return (jsonify({"error": problem[0]}), problem[1]) if problem else None
+
+def recount_usage():
+    """Rebuild the usage counters from the tables; a full scan, for upgrades and repairs"""
+    db.session.execute(db.delete(Counter).where(db.or_(
+        Counter.name.startswith("usage_"), Counter.name == "stored_bytes")))
+    counters = [{"name": "stored_bytes", "value": db.session.execute(
+        db.select(db.func.coalesce(db.func.sum(Blob.stored_size), 0))).scalar()}]
+    for owner, count, size in db.session.execute(
+        db.select(Document.owner, db.func.count(), db.func.coalesce(db.func.sum(Document.size), 0))
+        .where(Document.owner.is_not(None))
+        .group_by(Document.owner)
+    ):
+        counters += [{"name": f"usage_files:{owner}", "value": count},
+                     {"name": f"usage_bytes:{owner}", "value": size}]
+    db.session.execute(db.insert(Counter), counters)
+
+def current_owner():
+    """The caller's owner id from the session cookie, issued on first use"""
+    owner = session.get("owner")
+    if owner is None:
+        owner = session["owner"] = uuid.uuid4().hex
+        session.permanent = True
+    return owner
+
+def owned_document(file_id):
+    """The caller's document with this id; other owners' documents do not exist for them"""
+    doc = db.session.get(Document, file_id)
+    return doc if doc is not None and doc.owner == current_owner() else None
+
+def owned_upload(session_id):
+    """The caller's resumable upload with this id, scoped like :func:`owned_document`"""
+    upload = db.session.get(UploadSession, session_id)
+    return upload if upload is not None and upload.owner == current_owner() else None
+
+def raise_counter(name, value):
+    """Set a named counter to ``value`` unless it is already higher"""
+    raise_ = db.update(Counter).where(Counter.name == name, Counter.value < value).values(value=value)
+    if db.session.execute(raise_).rowcount or read_counter(name) >= value:
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.add(Counter(name=name, value=value))
+    except IntegrityError:
+        db.session.execute(raise_)
+
+def publish_event(owner, kind, **payload):
+    """Record a change to an owner's listing in the current transaction
+
+    Bumps the owner's listing version and queues the event for their
+    /events subscribers; call before committing.
+    """
+    # An autoincrement id is assigned at insert, not commit: on a database
+    # with concurrent writers a lower id could commit after the poller has
+    # moved past it. Bumping the counter locks its row until commit instead.
+    incr_counter("event_seq")
+    db.session.add(Event(id=read_counter("event_seq"), kind=kind, owner=owner, payload=payload))
+    db.session.info["events_published"] = True
+    touch_documents(owner)
+
+def publish_created(docs):
+    """Publish new documents as /get_files would list them; assigns their ids"""
+    db.session.flush()
+    statuses = dict(db.session.execute(
+        db.select(Blob.sha256, Blob.preview_status)
+        .where(Blob.sha256.in_({doc.checksum for doc in docs}))
+    ).all())
+    for owner in {doc.owner for doc in docs}:
+        publish_event(owner, "created", files=[
+            {"id": doc.id, "filename": doc.filename, "status": doc.status,
+             **preview_urls(doc.checksum, statuses.get(doc.checksum))}
+            for doc in docs if doc.owner == owner
+        ])
+
+def partial_path(session_id):
+    return os.path.join(app.config["UPLOAD_FOLDER"], ".partial", session_id)
+
+def expire_upload_sessions():
+    """Drop resumable uploads that have not received data within the TTL"""
+    cutoff = utcnow() - app.config["UPLOAD_SESSION_TTL"]
+    is_stale = UploadSession.updated_at < cutoff
+    stale = db.session.execute(db.select(UploadSession.id).where(is_stale)).scalars().all()
+    if not stale:
+        return
+    # A chunk may have arrived since the select; only sessions still stale go
+    db.session.execute(db.delete(UploadSession).where(UploadSession.id.in_(stale), is_stale))
+    kept = set(db.session.execute(
+        db.select(UploadSession.id).where(UploadSession.id.in_(stale))).scalars())
+    unlink_later(paths=[partial_path(session_id) for session_id in stale if session_id not in kept])
 
 # -------------------------
 # Routes
@@ -28,79 +696,1798 @@ def index():
     """Render upload page."""
     return render_template("index.html")
 
+LISTING_FIELDS = {
+    "id": Document.id,
+    "filename": Document.filename,
+    "status": Document.status,
+    "size": Document.size,
+    "checksum": Document.checksum,
+}
+# Computed from the document's blob; null until its previews have been rendered
+PREVIEW_FIELDS = {"thumbnail_url": "thumb", "preview_url": "preview"}
+
 @app.route("/get_files", methods=["GET"])
 def get_files():
-    """Return all uploaded files (for page refresh)"""
-    docs = Document.query.all()
-    files = [{"id": d.id, "filename": d.filename, "status": d.status} for d in docs]
-    return jsonify(files)
+    """Return the caller's uploaded files (for page refresh)
+
+    Query parameters:
+    - ``limit``: page size (default 100, at most 1000)
+    - ``after``: id cursor from the previous page's ``X-Next-Cursor`` header
+    - ``status``: only return files with this status
+    - ``fields``: comma-separated subset of id, filename, status, size, checksum,
+      thumbnail_url, preview_url
+    """
+    # The listing only changes when the owner's documents version does, so a
+    # matching ETag can be answered before any Document query runs
+    owner = current_owner()
+    version = read_counter(f"documents:{owner}")
+    digest = hashlib.sha1(owner.encode() + b"?" + request.query_string).hexdigest()[:12]
+    etag = f"files-{version}-{digest}"
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = "private, no-cache"
+        return response
+
+    try:
+        limit = min(int(request.args.get("limit", 100)), 1000)
+        after = int(request.args.get("after", 0))
+    except ValueError:
+        return jsonify({"error": "limit and after must be integers"}), 400
+    if limit < 1:
+        return jsonify({"error": "limit must be positive"}), 400
+
+    fields = request.args.get("fields")
+    names = fields.split(",") if fields else [
+        "id", "filename", "status", "thumbnail_url", "preview_url"]
+    unknown = [name for name in names if name not in LISTING_FIELDS and name not in PREVIEW_FIELDS]
+    if unknown:
+        return jsonify({"error": f"Unknown fields: {', '.join(unknown)}"}), 400
+
+    columns = [LISTING_FIELDS[name] for name in dict.fromkeys(["id", *names]) if name in LISTING_FIELDS]
+    query = (
+        db.select(*columns)
+        .where(Document.owner == owner, Document.id > after)
+        .order_by(Document.id)
+        .limit(limit + 1)
+    )
+    previews = [name for name in names if name in PREVIEW_FIELDS]
+    if previews:
+        query = query.add_columns(
+            Document.checksum.label("blob_checksum"), Blob.preview_status
+        ).outerjoin(Blob, Blob.sha256 == Document.checksum)
+    status = request.args.get("status")
+    if status:
+        query = query.where(Document.status == status)
+
+    rows = db.session.execute(query).all()
+    files = []
+    for row in rows[:limit]:
+        item = {name: getattr(row, name) for name in names if name in LISTING_FIELDS}
+        if previews:
+            urls = preview_urls(row.blob_checksum, row.preview_status)
+            item.update((name, urls[name]) for name in previews)
+        files.append(item)
+
+    response = jsonify(files)
+    if len(rows) > limit:
+        cursor = rows[limit - 1].id
+        response.headers["X-Next-Cursor"] = str(cursor)
+        args = request.args.to_dict()
+        args["after"] = cursor
+        response.headers["Link"] = f'<{url_for("get_files", **args)}>; rel="next"'
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+def document_for_key(key):
+    return Document.query.filter_by(upload_key=key).first() if key else None
+
+def replay_upload(key):
+    """What to answer instead of storing anything: the first result for a retried
+    Idempotency-Key, or an error for an invalid one; None to go ahead"""
+    if key is not None and len(key) > 64:
+        return jsonify({"error": "Idempotency-Key must be at most 64 characters"}), 400
+    existing = document_for_key(key)
+    if existing is not None and existing.owner != current_owner():
+        return jsonify({"error": "Idempotency-Key already used"}), 409
+    return uploaded_response(existing) if existing else None
+
+def uploaded_response(doc):
+    return jsonify({"message": "File uploaded", "id": doc.id, "filename": doc.filename,
+                    "size": doc.size, "checksum": doc.checksum})
+
+def commit_upload(doc, key):
+    """Commit a new document; a concurrent retry with the same key wins instead"""
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        replay = replay_upload(key)
+        if replay is None:
+            raise
+        return replay
+    return uploaded_response(doc)
 
 @app.route("/upload", methods=["POST"])
 def upload_file():
-    """Upload a single file (one-by-one)"""
-    file = request.files.get("file")
+    """Upload a single file (one-by-one)
+
+    Accepts either a multipart form with a ``file`` field or a raw
+    ``application/octet-stream`` body named by the ``X-Filename`` header.
+    Retrying with the same ``Idempotency-Key`` returns the first result.
+    """
+    key = request.headers.get("Idempotency-Key") or None
+    replay = replay_upload(key)
+    if replay:
+        return replay
+
+    # Allow for multipart overhead; the exact cap is enforced while streaming
+    request.max_content_length = upload_limit("single") + 64 * 1024
 
-    if not file or file.filename == "":
+    if request.mimetype == "application/octet-stream":
+        filename = clean_filename(unquote(request.headers.get("X-Filename", "")))
+        stream = request.stream
+    else:
+        file = request.files.get("file")
+        filename = clean_filename(file.filename) if file else ""
+        stream = file.stream if file else None
+
+    if not filename:
         return jsonify({"error": "No file uploaded"}), 400
 
-    # Check file size
-    file.seek(0, os.SEEK_END)
-    size = file.tell()
-    file.seek(0)
-    if size > 500 * 1024:
-        return jsonify({"error": "File exceeds 500KB limit"}), 400
+    try:
+        staged = receive_upload(stream, "single")
+    except UploadTooLarge:
+        return jsonify({"error": too_large_error("single")}), 400
+    error = quota_error(current_owner(), staged.size)
+    if error:
+        staged.discard()
+        return error
+
+    new_doc = store_staged(staged, filename, current_owner())
+    new_doc.upload_key = key
+    publish_created([new_doc])
+    return commit_upload(new_doc, key)
+
+@app.route("/lookup_hashes", methods=["POST"])
+def lookup_hashes():
+    """Report which of {"checksums": [sha256 hex, ...]} the caller already has stored
+
+    Only the caller's own documents count: answering for everyone's content
+    would tell any client whether some other user holds a given file.
+    """
+    request.max_content_length = app.config["MAX_HASH_LOOKUP"] * 70 + 1024
+    checksums = (request.get_json(silent=True) or {}).get("checksums")
+    if not isinstance(checksums, list) or not all(
+        isinstance(c, str) and HEX_SHA256.fullmatch(c) for c in checksums
+    ):
+        return jsonify({"error": "checksums must be a list of lowercase sha256 hex digests"}), 400
+    if len(checksums) > app.config["MAX_HASH_LOOKUP"]:
+        return jsonify({"error": f"At most {app.config['MAX_HASH_LOOKUP']} checksums per request"}), 400
+
+    known = db.session.execute(
+        db.select(Document.checksum)
+        .where(Document.owner == current_owner(), Document.checksum.in_(set(checksums)))
+        .distinct()
+    ).scalars().all()
+    return jsonify({"known": sorted(known)})
+
+@app.route("/upload_by_hash", methods=["POST"])
+def upload_by_hash():
+    """Add another copy of content the caller already has: {"filename", "checksum"}
 
-    os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
-    path = os.path.join(app.config["UPLOAD_FOLDER"], file.filename)
-    file.save(path)
+    Answers 404 when the caller has no document with that checksum; the
+    client then uploads the file.
+    """
+    key = request.headers.get("Idempotency-Key") or None
+    replay = replay_upload(key)
+    if replay:
+        return replay
 
-    new_doc = Document(filename=file.filename)
+    data = request.get_json(silent=True) or {}
+    filename = clean_filename(data.get("filename"))
+    checksum = data.get("checksum") or ""
+    if not filename or not HEX_SHA256.fullmatch(checksum):
+        return jsonify({"error": "filename and a sha256 checksum are required"}), 400
+
+    owner = current_owner()
+    owns_copy = db.select(Document.id).where(
+        Document.owner == owner, Document.checksum == checksum).exists()
+    blob = db.session.execute(db.select(Blob).where(Blob.sha256 == checksum, owns_copy)).scalar()
+    if blob is None or not blob_store().exists(checksum):
+        return jsonify({"error": "Content not stored; upload the file"}), 404
+    error = quota_error(owner, blob.size)
+    if error:
+        return error
+
+    if add_blob_ref(checksum, blob.size):
+        # Released since it was looked up; its file is queued for unlinking
+        db.session.rollback()
+        return jsonify({"error": "Content not stored; upload the file"}), 404
+    new_doc = Document(filename=filename, size=blob.size, stored_size=blob.stored_size,
+                       checksum=checksum, upload_key=key, owner=owner)
     db.session.add(new_doc)
+    charge_usage(owner, 1, blob.size)
+    publish_created([new_doc])
+    return commit_upload(new_doc, key)
+
+@app.route("/upload_batch", methods=["POST"])
+def upload_batch():
+    """Upload several files in one request and store them in one transaction"""
+    # The request carries the whole batch, so widen the global per-request cap
+    request.max_content_length = (
+        upload_limit("batch") * app.config["MAX_BATCH_FILES"] + 64 * 1024
+    )
+    files = [(clean_filename(f.filename), f) for f in request.files.getlist("files") if f]
+    files = [(name, f) for name, f in files if name]
+
+    if not files:
+        return jsonify({"error": "No files uploaded"}), 400
+    if len(files) > app.config["MAX_BATCH_FILES"]:
+        return jsonify({"error": f"At most {app.config['MAX_BATCH_FILES']} files per batch"}), 400
+
+    # Stream every file in first; rows are only inserted for files that fit
+    results = []
+    docs = []
+    for filename, file in files:
+        try:
+            staged = receive_upload(file.stream, "batch")
+        except UploadTooLarge:
+            results.append({"filename": filename, "error": too_large_error("batch")})
+            continue
+        # Files stored earlier in the batch are already charged in this transaction
+        problem = over_quota(current_owner(), staged.size)
+        if problem:
+            staged.discard()
+            results.append({"filename": filename, "error": problem[0]})
+            continue
+        results.append({"filename": filename})
+        docs.append((results[-1], store_staged(staged, filename, current_owner())))
+
+    if docs:
+        publish_created([doc for _, doc in docs])
+        db.session.commit()
+
+        for result, doc in docs:
+            result["id"] = doc.id
+            result["status"] = doc.status
+            result["checksum"] = doc.checksum
+
+    return jsonify({
+        "message": f"{len(docs)} of {len(files)} files uploaded",
+        "uploaded": len(docs),
+        "failed": len(files) - len(docs),
+        "files": results,
+    })
+
+@app.route("/files/<int:file_id>", methods=["GET", "HEAD"])
+def download_file(file_id):
+    """Send a stored file back (Range, conditional GET; ?download=1 for an attachment)"""
+    doc = owned_document(file_id)
+    if not doc:
+        return jsonify({"error": "File not found"}), 404
+
+    path = stored_path(doc)
+    if not os.path.isfile(path):
+        return jsonify({"error": "File content missing"}), 404
+
+    as_attachment = request.args.get("download") == "1"
+    blob = db.session.get(Blob, doc.checksum) if doc.checksum else None
+    compressed = blob is not None and blob.encoding == "gzip"
+    # Gzip blobs go out untouched to clients that accept gzip; others get them inflated
+    passthrough = compressed and request.accept_encodings["gzip"] > 0
+    etag = doc.checksum + "-gzip" if passthrough else doc.checksum
+    if compressed and not passthrough:
+        return inflated_response(doc, path, as_attachment)
+
+    accel_prefix = app.config["DOWNLOAD_ACCEL_REDIRECT"]
+    if accel_prefix:
+        # Answer revalidation here; otherwise let the proxy stream the bytes
+        mimetype = mimetypes.guess_type(doc.filename)[0] or "application/octet-stream"
+        response = app.response_class(status=200, mimetype=mimetype)
+        if etag:
+            response.set_etag(etag)
+            if request.if_none_match.contains(etag):
+                response.status_code = 304
+                return response
+        relative = os.path.relpath(path, app.config["UPLOAD_FOLDER"]).replace(os.sep, "/")
+        response.headers["X-Accel-Redirect"] = accel_prefix.rstrip("/") + "/" + relative
+        set_disposition(response, doc.filename, as_attachment)
+    else:
+        # send_file handles Range, If-None-Match/If-Modified-Since, Last-Modified
+        # from the file's mtime, and wsgi.file_wrapper (sendfile) when available
+        response = send_file(
+            os.path.abspath(path),
+            download_name=doc.filename,
+            as_attachment=as_attachment,
+            conditional=True,
+            etag=etag or True,
+        )
+    if passthrough:
+        response.headers["Content-Encoding"] = "gzip"
+    if compressed:
+        response.vary.add("Accept-Encoding")
+    return response
+
+@app.route("/previews/<checksum>/<variant>.webp", methods=["GET", "HEAD"])
+def get_preview(checksum, variant):
+    """Serve a rendered thumbnail or preview; the URL changes whenever the content does"""
+    if not HEX_SHA256.fullmatch(checksum) or variant not in thumbnails.VARIANTS:
+        return jsonify({"error": "Preview not found"}), 404
+    path = thumbnails.derivative_path(derived_base(checksum), variant)
+    if not os.path.isfile(path):
+        return jsonify({"error": "Preview not found"}), 404
+
+    response = send_file(
+        os.path.abspath(path),
+        mimetype=thumbnails.MIMETYPE,
+        conditional=True,
+        etag=f"{checksum}-{variant}",
+        max_age=app.config["PREVIEW_MAX_AGE"],
+    )
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+@app.route("/files/<int:file_id>", methods=["PUT"])
+def replace_file(file_id):
+    """Replace a file's content in place, keeping its id
+
+    The body is streamed like /upload (raw with ``X-Filename``, or multipart
+    ``file``); without a new name the old one is kept. The new content is
+    stored before the row switches to it in one transaction, and the old
+    content is only unlinked after that commits. ``If-Match`` with the
+    download ETag guards against overwriting someone else's replacement.
+    """
+    doc = owned_document(file_id)
+    if not doc:
+        return jsonify({"error": "File not found"}), 404
+    old_checksum = doc.checksum
+    etags = {old_checksum, f"{old_checksum}-gzip"} if old_checksum else set()
+    if request.if_match and not (request.if_match.star_tag or any(map(request.if_match.contains, etags))):
+        return jsonify({"error": "File has changed"}), 412
+
+    request.max_content_length = upload_limit("single") + 64 * 1024
+    if request.mimetype == "application/octet-stream":
+        filename = clean_filename(unquote(request.headers.get("X-Filename", "")))
+        stream = request.stream
+    else:
+        file = request.files.get("file")
+        if not file:
+            return jsonify({"error": "No file uploaded"}), 400
+        filename, stream = clean_filename(file.filename), file.stream
+    filename = filename or doc.filename
+
+    try:
+        staged = receive_upload(stream, "single")
+    except UploadTooLarge:
+        return jsonify({"error": too_large_error("single")}), 400
+    error = quota_error(doc.owner, staged.size - (doc.size or 0))
+    if error:
+        staged.discard()
+        return error
+
+    # Conditional on the content we read, so concurrent replacements cannot
+    # both release the same old blob
+    unchanged = Document.checksum == old_checksum if old_checksum else Document.checksum.is_(None)
+    swapped = db.session.execute(
+        db.update(Document)
+        .where(Document.id == file_id, unchanged)
+        .values(checksum=staged.sha256)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if not swapped:
+        staged.discard()
+        db.session.rollback()
+        return jsonify({"error": "File was replaced concurrently; retry"}), 409
+
+    stored_size = put_blob(staged, filename)
+    unlink_later(*release_blob(doc))  # doc still carries the old checksum, name and size
+    charge_usage(doc.owner, 0, staged.size - (doc.size or 0))
+    db.session.execute(
+        db.update(Document)
+        .where(Document.id == file_id)
+        .values(filename=filename, size=staged.size, stored_size=stored_size, status="pending")
+        .execution_options(synchronize_session=False)
+    )
+    preview_status = db.session.execute(
+        db.select(Blob.preview_status).where(Blob.sha256 == staged.sha256)
+    ).scalar()
+    publish_event(doc.owner, "updated", ids=[file_id], changes={
+        "filename": filename, "status": "pending", **preview_urls(staged.sha256, preview_status)})
     db.session.commit()
 
-    return jsonify({"message": "File uploaded", "id": new_doc.id, "filename": new_doc.filename})
+    return jsonify({"message": "File replaced", "id": file_id, "filename": filename,
+                    "size": staged.size, "checksum": staged.sha256})
+
+def set_disposition(response, filename, as_attachment):
+    disposition = "attachment" if as_attachment else "inline"
+    if filename.isascii():
+        response.headers.set("Content-Disposition", disposition, filename=filename)
+    else:
+        response.headers.set("Content-Disposition", disposition,
+                             **{"filename*": f"UTF-8''{quote(filename)}"})
+
+def inflated_response(doc, path, as_attachment):
+    """Stream a gzip blob's original bytes to a client that did not ask for gzip"""
+    def generate():
+        with open_stored(path, "gzip") as f:
+            for chunk in iter(lambda: f.read(app.config["UPLOAD_CHUNK_SIZE"]), b""):
+                yield chunk
+
+    mimetype = mimetypes.guess_type(doc.filename)[0] or "application/octet-stream"
+    response = app.response_class(generate(), mimetype=mimetype, direct_passthrough=True)
+    response.content_length = doc.size
+    response.last_modified = datetime.fromtimestamp(os.path.getmtime(path), timezone.utc)
+    response.set_etag(doc.checksum)
+    response.cache_control.no_cache = True
+    response.vary.add("Accept-Encoding")
+    set_disposition(response, doc.filename, as_attachment)
+    # Ranges are cut from the inflated stream, so resumed downloads work here too
+    return response.make_conditional(request, accept_ranges=True, complete_length=doc.size)
+
+def export_members(owner, status):
+    """``(name, path, encoding, size)`` for an owner's files, one batch query at a time"""
+    after = 0
+    while True:
+        # A short app context per batch, so no connection is held while bytes stream
+        with app.app_context():
+            query = (
+                db.select(Document.id, Document.filename, Document.checksum, Document.size, Blob.encoding)
+                .outerjoin(Blob, Blob.sha256 == Document.checksum)
+                .where(Document.owner == owner, Document.id > after)
+                .order_by(Document.id)
+                .limit(app.config["EXPORT_BATCH"])
+            )
+            if status:
+                query = query.where(Document.status == status)
+            rows = db.session.execute(query).all()
+            members = []
+            for row in rows:
+                path = stored_path(row)
+                content_addressed = row.checksum and path == blob_path(row.checksum)
+                encoding = row.encoding if content_addressed else "identity"
+                members.append((row.filename, path, encoding or "identity", row.size))
+        yield from members
+        if len(rows) < app.config["EXPORT_BATCH"]:
+            return
+        after = rows[-1].id
+
+@app.route("/export", methods=["GET"])
+def export_files():
+    """Download the caller's files as one ZIP archive
+
+    Query parameters:
+    - ``status``: only include files with this status (e.g. ``saved``)
+
+    The archive is built while it is sent, so memory use does not grow with
+    the number or size of the files. Duplicate names get a `` (2)`` suffix.
+    """
+    owner = current_owner()
+    status = request.args.get("status")
+    db.session.close()  # release the connection before the stream outlives the request
+
+    archive = stream_zip(export_members(owner, status), app.config["UPLOAD_CHUNK_SIZE"])
+    response = app.response_class(archive, mimetype="application/zip")
+    set_disposition(response, f"files-{utcnow():%Y%m%d-%H%M%S}.zip", as_attachment=True)
+    response.headers["Cache-Control"] = "private, no-store"
+    response.headers["X-Accel-Buffering"] = "no"  # nginx: stream instead of buffering to disk
+    return response
+
+# -------------------------
+# Resumable Uploads
+# -------------------------
+def upload_session_response(upload, status=200):
+    response = jsonify({"id": upload.id, "filename": upload.filename,
+                        "offset": upload.offset, "length": upload.length})
+    response.status_code = status
+    response.headers["Upload-Offset"] = str(upload.offset)
+    response.headers["Cache-Control"] = "no-store"
+    return response
+
+def current_upload(session_id):
+    """The session row as committed now, not as this request first loaded it"""
+    return db.session.get(UploadSession, session_id, populate_existing=True)
+
+def current_upload_response(session_id, status=200):
+    upload = current_upload(session_id)
+    if upload is None:
+        return jsonify({"error": "Upload not found"}), 404
+    return upload_session_response(upload, status)
+
+def lock_upload(session_id):
+    """Lock a session's partial file for this request, or None if another request has it"""
+    try:
+        return try_lock(partial_path(session_id))
+    except FileNotFoundError:
+        return None
+
+@app.route("/uploads", methods=["POST"])
+def create_upload_session():
+    """Start a resumable upload: {"filename": ..., "length": optional total bytes}"""
+    data = request.get_json(silent=True) or {}
+    filename = clean_filename(data.get("filename"))
+    length = data.get("length")
+
+    if not filename:
+        return jsonify({"error": "No filename given"}), 400
+    if length is not None and (not isinstance(length, int) or length < 0):
+        return jsonify({"error": "Invalid length"}), 400
+    if length is not None and length > upload_limit("resumable"):
+        return jsonify({"error": too_large_error("resumable")}), 400
+    error = quota_error(current_owner(), length or 0)
+    if error:
+        return error
+
+    upload = UploadSession(owner=current_owner(), filename=filename, length=length)
+    db.session.add(upload)
+    db.session.commit()
+
+    open(partial_path(upload.id), "wb").close()
+
+    response = upload_session_response(upload, 201)
+    response.headers["Location"] = f"/uploads/{upload.id}"
+    return response
+
+@app.route("/uploads/<session_id>", methods=["GET", "HEAD"])
+def get_upload_session(session_id):
+    """Report how many bytes of a resumable upload have been received"""
+    upload = owned_upload(session_id)
+    if not upload:
+        return jsonify({"error": "Upload not found"}), 404
+    return upload_session_response(upload)
+
+@app.route("/uploads/<session_id>", methods=["PATCH"])
+def patch_upload_session(session_id):
+    """Append a chunk; the Upload-Offset header must match the current offset
+
+    One request writes to a session at a time; a concurrent or stale PATCH
+    gets 409 with the current offset, as does one that lost the offset update.
+    """
+    # Werkzeug turns a read that reaches its cap into 413 even at end of body,
+    # so allow one byte more; append_stream enforces the real limit
+    request.max_content_length = app.config["RESUMABLE_CHUNK_LIMIT"] + 1
+
+    upload = owned_upload(session_id)
+    if not upload:
+        return jsonify({"error": "Upload not found"}), 404
+    try:
+        offset = int(request.headers["Upload-Offset"])
+    except (KeyError, ValueError):
+        return jsonify({"error": "Missing or invalid Upload-Offset header"}), 400
+
+    lock = lock_upload(upload.id)
+    if lock is None:
+        return current_upload_response(session_id, 409)
+    with lock:
+        upload = current_upload(session_id)  # as of taking the lock
+        if upload is None:
+            return jsonify({"error": "Upload not found"}), 404
+        if offset != upload.offset:
+            return upload_session_response(upload, 409)
+
+        remaining = upload_limit("resumable") - offset
+        if upload.length is not None:
+            remaining = min(remaining, upload.length - offset)
+
+        start = time.perf_counter()
+        try:
+            written = append_stream(
+                request.stream,
+                partial_path(upload.id),
+                offset,
+                min(remaining, app.config["RESUMABLE_CHUNK_LIMIT"]),
+                app.config["UPLOAD_CHUNK_SIZE"],
+            )
+        except UploadTooLarge:
+            return jsonify({"error": too_large_error("resumable")}), 400
+        record_upload("resumable", written, time.perf_counter() - start)
+
+        advanced = db.session.execute(
+            db.update(UploadSession)
+            .where(UploadSession.id == upload.id, UploadSession.offset == offset)
+            .values(offset=offset + written, updated_at=utcnow())
+        ).rowcount
+        db.session.commit()
+    if not advanced:
+        return current_upload_response(session_id, 409)
+    return current_upload_response(session_id)
+
+@app.route("/uploads/<session_id>/finalize", methods=["POST"])
+def finalize_upload_session(session_id):
+    """Turn a fully received resumable upload into a Document"""
+    upload = owned_upload(session_id)
+    if not upload:
+        return jsonify({"error": "Upload not found"}), 404
+    lock = lock_upload(upload.id)
+    if lock is None:
+        return current_upload_response(session_id, 409)  # a chunk is still arriving
+    with lock:
+        return finalize_locked_upload(session_id)
+
+def finalize_locked_upload(session_id):
+    upload = current_upload(session_id)
+    if upload is None:
+        return jsonify({"error": "Upload not found"}), 404  # finalized or aborted meanwhile
+    if upload.length is not None and upload.offset != upload.length:
+        return upload_session_response(upload, 409)
+
+    path = partial_path(upload.id)
+    size, checksum = run_blocking(hash_file, path, app.config["UPLOAD_CHUNK_SIZE"])
+    expected = (request.get_json(silent=True) or {}).get("checksum")
+    if expected and expected.lower() != checksum:
+        return jsonify({"error": "Checksum mismatch", "checksum": checksum}), 400
+    error = quota_error(current_owner(), size)
+    if error:
+        return error
+
+    # Compressed before the row below takes the write lock, which must not be
+    # held (or, under gevent, yielded) through seconds of work
+    encoding, stored_size = "identity", size
+    known = db.session.execute(db.select(Blob.sha256).where(Blob.sha256 == checksum)).scalar()
+    if app.config["COMPRESS_UPLOADS"] and known is None:
+        encoding, stored_size = run_blocking(compress_file, path, app.config["COMPRESS_LEVEL"])
+
+    # Row first, as in put_blob, so a pending unlink of the same content cannot
+    # remove the file this places
+    if not add_blob_ref(checksum, size) and blob_store().touch(checksum):
+        unlink_later(paths=[path])
+        stored_size = blob_stored_size(checksum, size)
+    else:
+        blob_store().put_file(path, checksum, replace=True)
+        set_blob_storage(checksum, encoding, stored_size)
+        queue_previews(checksum, upload.filename)
+
+    new_doc = Document(filename=upload.filename, size=size, stored_size=stored_size,
+                       checksum=checksum, owner=current_owner())
+    db.session.add(new_doc)
+    charge_usage(new_doc.owner, 1, size)
+    db.session.delete(upload)
+    publish_created([new_doc])
+    db.session.commit()
+
+    return jsonify({"message": "File uploaded", "id": new_doc.id, "filename": new_doc.filename,
+                    "size": size, "checksum": checksum})
+
+@app.route("/uploads/<session_id>", methods=["DELETE"])
+def abort_upload_session(session_id):
+    """Abandon a resumable upload and discard the received bytes"""
+    upload = owned_upload(session_id)
+    if not upload:
+        return jsonify({"error": "Upload not found"}), 404
+    unlink_later(paths=[partial_path(upload.id)])
+    db.session.delete(upload)
+    db.session.commit()
+    return jsonify({"message": "Upload aborted"})
+
+@app.route("/claim_legacy", methods=["POST"])
+def claim_legacy_documents():
+    """Adopt every document stored before owner scoping: {"token": LEGACY_CLAIM_TOKEN}"""
+    token = app.config["LEGACY_CLAIM_TOKEN"]
+    given = str((request.get_json(silent=True) or {}).get("token") or "")
+    if not token or not hmac.compare_digest(given.encode(), token.encode()):
+        return jsonify({"error": "Not found"}), 404
+
+    owner = current_owner()
+    docs = Document.query.filter(Document.owner.is_(None)).order_by(Document.id).all()
+    if docs:
+        claimed = db.session.execute(
+            db.update(Document)
+            .where(Document.id.in_([doc.id for doc in docs]), Document.owner.is_(None))
+            .values(owner=owner)
+        ).rowcount
+        if claimed != len(docs):
+            db.session.rollback()
+            return jsonify({"error": "Documents were claimed concurrently; retry"}), 409
+        charge_usage(owner, len(docs), sum(doc.size or 0 for doc in docs))
+        publish_created(docs)
+        db.session.commit()
+    return jsonify({"message": f"Claimed {len(docs)} documents", "claimed": len(docs)})
 
 @app.route("/remove/<int:file_id>", methods=["DELETE"])
 def remove_file(file_id):
     """Remove a specific uploaded file"""
-    doc = Document.query.get(file_id)
+    doc = owned_document(file_id)
     if not doc:
         return jsonify({"error": "File not found"}), 404
 
-    try:
-        os.remove(os.path.join(app.config["UPLOAD_FOLDER"], doc.filename))
-    except FileNotFoundError:
-        pass
-
+    unlink_later(*release_blob(doc))
     db.session.delete(doc)
+    charge_usage(doc.owner, -1, -(doc.size or 0))
+    publish_event(doc.owner, "deleted", ids=[doc.id])
     db.session.commit()
     return jsonify({"message": f"File '{doc.filename}' removed successfully"})
 
 @app.route("/submit", methods=["POST"])
 def submit_all():
-    """Mark all files as saved"""
-    docs = Document.query.all()
-    for doc in docs:
-        doc.status = "saved"
+    """Mark all of the caller's files as saved"""
+    owner = current_owner()
+    updated = db.session.execute(
+        db.update(Document)
+        .where(Document.owner == owner, Document.status != "saved")
+        .values(status="saved")
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if updated:
+        publish_event(owner, "updated", all=True, changes={"status": "saved"})
     db.session.commit()
-    return jsonify({"message": "All files marked as saved on server"})
+    return jsonify({"message": "All files marked as saved on server", "updated": updated})
 
 @app.route("/cancel", methods=["POST"])
 def cancel_upload():
-    """Cancel all uploads and delete files"""
-    docs = Document.query.all()
-    for doc in docs:
+    """Cancel all of the caller's uploads and delete their files"""
+    owner = current_owner()
+    deleted, checksums, paths = release_documents(Document.owner == owner)
+    unlink_later(checksums, paths)
+    if deleted:
+        publish_event(owner, "deleted", all=True)
+    db.session.commit()
+    return jsonify({"message": "All uploaded files removed (cancelled)", "deleted": deleted,
+                    "files_to_unlink": len(checksums) + len(paths)})
+
+@app.route("/jobs", methods=["GET"])
+def job_status():
+    """Report background work that is still outstanding"""
+    counts = dict(db.session.execute(
+        db.select(Job.status, db.func.count()).group_by(Job.status)
+    ).all())
+    oldest = db.session.execute(
+        db.select(db.func.min(Job.created_at)).where(Job.status == "pending")
+    ).scalar()
+    failed = Job.query.filter_by(status="failed").order_by(Job.id.desc()).limit(20).all()
+    return jsonify({
+        "pending": counts.get("pending", 0),
+        "running": counts.get("running", 0),
+        "failed": counts.get("failed", 0),
+        "oldest_pending_seconds": (utcnow() - oldest).total_seconds() if oldest else None,
+        "recent_failures": [
+            {"id": j.id, "kind": j.kind, "attempts": j.attempts, "error": j.last_error}
+            for j in failed
+        ],
+    })
+
+# -------------------------
+# Background Jobs
+# -------------------------
+JOB_HANDLERS = {}
+job_wakeup = threading.Event()
+job_workers = {"pid": None, "threads": []}
+
+def job_handler(kind):
+    """Register the function that runs jobs of ``kind``; it receives the payload as kwargs"""
+    def register(fn):
+        JOB_HANDLERS[kind] = fn
+        return fn
+    return register
+
+def enqueue_job(kind, payload=None, delay=None):
+    """Add a job to the current transaction; it runs once that commits"""
+    job = Job(kind=kind, payload=payload or {},
+              run_after=utcnow() + (delay or timedelta(0)))
+    db.session.add(job)
+    db.session.info["jobs_enqueued"] = True
+    return job
+
+@event.listens_for(Session, "after_commit")
+def wake_job_workers(session):
+    if session.info.pop("jobs_enqueued", False):
+        job_wakeup.set()
+
+def recover_jobs():
+    """Requeue jobs left running by a process that died mid-job"""
+    db.session.execute(db.update(Job).where(Job.status == "running").values(status="pending"))
+    db.session.commit()
+
+def claimable(now):
+    """Jobs that are due, or still marked running after their worker's lease ran out"""
+    expired = now - app.config["JOB_LEASE"]
+    return db.or_(
+        db.and_(Job.status == "pending", Job.run_after <= now),
+        db.and_(Job.status == "running", db.or_(Job.claimed_at.is_(None), Job.claimed_at < expired)),
+    )
+
+def run_next_job():
+    """Claim and run one due job; returns False when there was nothing to do"""
+    now = utcnow()
+    job_id = db.session.execute(
+        db.select(Job.id)
+        .where(claimable(now))
+        .order_by(Job.run_after, Job.id)
+        .limit(1)
+    ).scalar()
+    if job_id is None:
+        return False
+
+    # Conditional update so only one worker (in any process) wins the job
+    claimed = db.session.execute(
+        db.update(Job)
+        .where(Job.id == job_id, claimable(now))
+        .values(status="running", attempts=Job.attempts + 1, claimed_at=now)
+    ).rowcount
+    db.session.commit()
+    if not claimed:
+        return True
+
+    job = db.session.get(Job, job_id)
+    if job.attempts > app.config["JOB_MAX_ATTEMPTS"]:
+        # Only reachable through expired leases: the job keeps taking its worker down
+        job.status = "failed"
+        job.last_error = job.last_error or "Worker exited while running the job"
+        db.session.commit()
+        return True
+    try:
+        JOB_HANDLERS[job.kind](**job.payload)
+    except Exception as exc:
+        db.session.rollback()
+        app.logger.exception("Job %s (%s) failed", job_id, job.kind)
+        job = db.session.get(Job, job_id)
+        job.last_error = job_error(exc)
+        if job.attempts >= app.config["JOB_MAX_ATTEMPTS"]:
+            job.status = "failed"
+        else:
+            job.status = "pending"
+            job.run_after = utcnow() + timedelta(seconds=2 ** job.attempts)
+    else:
+        db.session.delete(job)
+    db.session.commit()
+    return True
+
+def job_error(exc):
+    """What /jobs shows for a failure: the exception class and a message without data
+
+    Anyone can read /jobs, so no traceback, SQL parameters or file paths;
+    those go to the server log.
+    """
+    if isinstance(exc, DBAPIError) and exc.orig is not None:
+        exc = exc.orig  # the driver's message, without the statement and its parameters
+    detail = exc.strerror if isinstance(exc, OSError) else str(exc)
+    return f"{type(exc).__name__}: {detail}"[:200] if detail else type(exc).__name__
+
+def job_worker_loop():
+    while True:
         try:
-            os.remove(os.path.join(app.config["UPLOAD_FOLDER"], doc.filename))
+            with app.app_context():
+                ran = run_next_job()
+        except Exception:
+            app.logger.exception("Job worker iteration failed")
+            ran = False
+        if not ran:
+            job_wakeup.wait(app.config["JOB_POLL_INTERVAL"])
+            job_wakeup.clear()
+
+def start_job_workers():
+    """Start this process's worker threads (once per process, fork-safe)"""
+    if job_workers["pid"] == os.getpid():
+        return
+    job_workers["pid"] = os.getpid()
+    job_workers["threads"] = []
+    for n in range(app.config["JOB_WORKERS"]):
+        thread = threading.Thread(target=job_worker_loop, name=f"job-worker-{n}", daemon=True)
+        thread.start()
+        job_workers["threads"].append(thread)
+
+@app.before_request
+def ensure_job_workers():
+    start_job_workers()
+
+@job_handler("unlink")
+def unlink_job(checksums=(), paths=(), rendered=None):
+    unlink_many(paths)
+    if checksums:
+        unlink_blobs(checksums, rendered)
+
+def unlink_blobs(checksums, rendered=None):
+    """Remove the files of released blobs, skipping any stored again since
+
+    Works through UNLINK_BATCH checksums per transaction. While placeholder
+    Blob rows claim a batch, its files are only renamed aside; an upload of
+    the same content inserts its row before it places the file, so it
+    either committed first (and the checksum is skipped) or waits for the
+    rename and writes a fresh file. The renamed files are deleted after the
+    commit, so slow unlinks never hold the write lock. Derivatives are only
+    looked for on blobs in ``rendered`` (on all of them when None, for jobs
+    queued before that was recorded).
+    """
+    size = app.config["UNLINK_BATCH"]
+    for start in range(0, len(checksums), size):
+        batch = checksums[start:start + size]
+        stored = set(db.session.execute(db.select(Blob.sha256).where(Blob.sha256.in_(batch))).scalars())
+        free = [checksum for checksum in batch if checksum not in stored]
+        if not free:
+            continue
+        # A row committed since the read above fails the insert and the job is
+        # retried; batches already done find nothing left to remove
+        db.session.execute(db.insert(Blob), [
+            {"sha256": checksum, "size": 0, "refcount": 0, "stored_size": 0} for checksum in free])
+        doomed = move_aside(path for checksum in free for path in blob_files(
+            checksum, "ready" if rendered is None or checksum in rendered else None))
+        db.session.execute(db.delete(Blob).where(Blob.sha256.in_(free), Blob.refcount == 0))
+        db.session.commit()
+        unlink_many(doomed)
+
+preview_pool_state = {"pid": None, "pool": None}
+preview_pool_lock = threading.Lock()
+
+def preview_pool():
+    """This process's image rendering pool, created on first use (fork-safe)"""
+    with preview_pool_lock:
+        if preview_pool_state["pid"] != os.getpid():
+            # Spawned, not forked: children must not inherit the app's threads and sockets
+            preview_pool_state["pool"] = ProcessPoolExecutor(
+                max_workers=app.config["PREVIEW_PROCESSES"],
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+            preview_pool_state["pid"] = os.getpid()
+        return preview_pool_state["pool"]
+
+@job_handler("previews")
+def previews_job(checksum):
+    blob = db.session.get(Blob, checksum)
+    if blob is None or blob.preview_status is not None:
+        return
+    base = derived_base(checksum)
+    future = preview_pool().submit(
+        thumbnails.render_derivatives, blob_path(checksum), blob.encoding, base)
+    try:
+        variants = future.result(timeout=app.config["PREVIEW_TIMEOUT"])
+    except BrokenProcessPool:
+        # A render crashed its worker process; start a fresh pool for the retry
+        with preview_pool_lock:
+            preview_pool_state["pid"] = None
+        raise
+
+    marked = db.session.execute(
+        db.update(Blob)
+        .where(Blob.sha256 == checksum)
+        .values(preview_status="ready" if variants else "none")
+    ).rowcount
+    if not marked:
+        # The blob was deleted while rendering
+        unlink_many(thumbnails.derivative_path(base, variant) for variant in variants)
+    elif variants:
+        by_owner = collections.defaultdict(list)
+        for doc_id, owner in db.session.execute(
+            db.select(Document.id, Document.owner).where(Document.checksum == checksum)
+        ):
+            by_owner[owner].append(doc_id)
+        for owner, ids in by_owner.items():
+            publish_event(owner, "updated", ids=ids, changes=preview_urls(checksum, "ready"))
+    db.session.commit()
+
+# -------------------------
+# Live Updates (Server-Sent Events)
+# -------------------------
+event_wakeup = threading.Event()
+event_condition = threading.Condition()
+# Recent events as (id, kind, payload, owner); every event with id > "floor" is in the buffer
+event_buffer = collections.deque()
+event_poller = {"pid": None, "last_id": 0, "floor": 0}
+
+@event.listens_for(Session, "after_commit")
+def wake_event_poller(session):
+    if session.info.pop("events_published", False):
+        event_wakeup.set()
+
+def latest_event_id():
+    """Highest event id committed so far, including pruned ones"""
+    return read_counter("event_seq")
+
+def load_events(after, limit=500):
+    """Events newer than ``after`` straight from the database"""
+    with app.app_context():
+        rows = db.session.execute(
+            db.select(Event.id, Event.kind, Event.payload, Event.owner)
+            .where(Event.id > after)
+            .order_by(Event.id)
+            .limit(limit)
+        ).all()
+    return [tuple(row) for row in rows]
+
+def prune_events():
+    """Delete events past the retention window and remember how far that went"""
+    cutoff = utcnow() - app.config["EVENTS_RETENTION"]
+    newest = db.session.execute(
+        db.select(db.func.max(Event.id)).where(Event.created_at < cutoff)
+    ).scalar()
+    if newest is not None:
+        db.session.execute(db.delete(Event).where(Event.id <= newest))
+        raise_counter("events_pruned", newest)
+
+@job_handler("prune_events")
+def prune_events_job():
+    prune_events()
+    enqueue_job("prune_events", delay=timedelta(minutes=10))
+
+@job_handler("expire_uploads")
+def expire_uploads_job():
+    expire_upload_sessions()
+    enqueue_job("expire_uploads", delay=timedelta(minutes=10))
+
+def schedule_recurring(kind):
+    """Start a self-rescheduling job unless one is already queued"""
+    queued = db.session.execute(
+        db.select(Job.id).where(Job.kind == kind, Job.status != "failed").limit(1)
+    ).scalar()
+    if queued is None:
+        enqueue_job(kind)
+        db.session.commit()
+
+def event_poller_loop():
+    while True:
+        try:
+            events = load_events(event_poller["last_id"])
+            if events:
+                with event_condition:
+                    event_buffer.extend(events)
+                    event_poller["last_id"] = events[-1][0]
+                    while len(event_buffer) > app.config["EVENTS_BUFFER"]:
+                        event_poller["floor"] = event_buffer.popleft()[0]
+                    event_condition.notify_all()
+        except Exception:
+            app.logger.exception("Event poller iteration failed")
+            events = []
+        if len(events) < 500:
+            event_wakeup.wait(app.config["EVENTS_POLL_INTERVAL"])
+            event_wakeup.clear()
+
+def start_event_poller():
+    """Start this process's poller thread on its first subscriber (fork-safe)"""
+    with event_condition:
+        if event_poller["pid"] == os.getpid():
+            return
+        start = latest_event_id()
+        event_poller.update(pid=os.getpid(), last_id=start, floor=start)
+        event_buffer.clear()
+    threading.Thread(target=event_poller_loop, name="event-poller", daemon=True).start()
+
+def events_after(cursor, owner):
+    """An owner's events newer than ``cursor``, and the id scanned up to
+
+    Served from the buffer, falling back to the database for old cursors.
+    """
+    with event_condition:
+        if cursor >= event_poller["floor"]:
+            scanned = [e for e in event_buffer if e[0] > cursor]
+        else:
+            scanned = None
+    if scanned is None:
+        scanned = load_events(cursor)
+    upto = scanned[-1][0] if scanned else cursor
+    return [e for e in scanned if e[3] == owner], upto
+
+def format_event(event_id, kind, payload):
+    return f"id: {event_id}\nevent: {kind}\ndata: {json.dumps(payload, separators=(',', ':'))}\n\n"
+
+def event_stream(cursor, owner, greeting):
+    EVENT_SUBSCRIBERS.inc()
+    try:
+        yield f"retry: 2000\n\n{greeting}"
+        deadline = time.monotonic() + app.config["EVENTS_STREAM_SECONDS"]
+        while time.monotonic() < deadline:
+            events, upto = events_after(cursor, owner)
+            for event_id, kind, payload, _ in events:
+                yield format_event(event_id, kind, payload)
+            if upto > cursor:
+                cursor = upto
+                continue
+            with event_condition:
+                if event_poller["last_id"] <= cursor:
+                    event_condition.wait(app.config["EVENTS_HEARTBEAT"])
+                idle = event_poller["last_id"] <= cursor
+            if idle:
+                # The id moves the client's resume point past other owners' events
+                yield f": keepalive\nid: {cursor}\n\n"
+    finally:
+        EVENT_SUBSCRIBERS.dec()
+
+@app.route("/events", methods=["GET"])
+def stream_events():
+    """Stream changes to the caller's listing as Server-Sent Events
+
+    Each event is ``created`` ({"files": [...]}, entries as /get_files lists
+    them), ``updated`` ({"ids": [...]} or {"all": true}, plus "changes") or
+    ``deleted`` ({"ids": [...]} or {"all": true}); applying them by id is
+    idempotent. A new stream starts with ``ready``; resuming through
+    Last-Event-ID (or ``?after=``) from a pruned or unknown id yields
+    ``reset``, meaning the client should refetch /get_files.
+    """
+    if EVENT_SUBSCRIBERS.value() >= app.config["EVENTS_MAX_SUBSCRIBERS"]:
+        response = jsonify({"error": "Too many event subscribers"})
+        response.status_code = 503
+        response.headers["Retry-After"] = "10"
+        return response
+    start_event_poller()
+
+    latest = latest_event_id()
+    resume = request.headers.get("Last-Event-ID") or request.args.get("after")
+    try:
+        cursor = int(resume) if resume else None
+    except ValueError:
+        cursor = -1
+    if cursor is None:
+        cursor, greeting = latest, format_event(latest, "ready", {})
+    elif not read_counter("events_pruned") <= cursor <= latest:
+        cursor, greeting = latest, format_event(latest, "reset", {})
+    else:
+        greeting = ""
+    owner = current_owner()
+    db.session.close()  # release the connection before the stream outlives the request
+
+    response = app.response_class(event_stream(cursor, owner, greeting),
+                                  mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"  # nginx: pass events through unbuffered
+    return response
+
+# -------------------------
+# Metrics and Profiling
+# -------------------------
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    g.route = request.url_rule.rule if request.url_rule else "unmatched"
+    REQUESTS_IN_FLIGHT.inc(route=g.route)
+
+    if app.config["PROFILING_ENABLED"] and request.headers.get("X-Profile") == "1":
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+@app.after_request
+def finish_request_metrics(response):
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        profiler.disable()
+        os.makedirs(app.config["PROFILE_DIR"], exist_ok=True)
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{request.endpoint}-{os.getpid()}-{id(profiler):x}.prof"
+        path = os.path.join(app.config["PROFILE_DIR"], name)
+        profiler.dump_stats(path)
+        response.headers["X-Profile-Output"] = path
+    g.status = response.status_code
+    return response
+
+@app.teardown_request
+def record_request_metrics(exc):
+    if "request_start" not in g:
+        return
+    REQUESTS_IN_FLIGHT.dec(route=g.route)
+    REQUEST_SECONDS.observe(
+        time.perf_counter() - g.request_start,
+        method=request.method, route=g.route, status=g.get("status", 500),
+    )
+
+@event.listens_for(Engine, "before_cursor_execute")
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+@event.listens_for(Engine, "after_cursor_execute")
+def record_query_time(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info["query_start"].pop()
+    verb = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "OTHER"
+    DB_QUERY_SECONDS.observe(time.perf_counter() - start, statement=verb)
+
+@event.listens_for(Session, "before_commit")
+def start_commit_timer(session):
+    session.info["commit_start"] = time.perf_counter()
+
+@event.listens_for(Session, "after_commit")
+def record_commit_time(session):
+    start = session.info.pop("commit_start", None)
+    if start is not None:
+        DB_COMMIT_SECONDS.observe(time.perf_counter() - start)
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    """Prometheus text exposition of the server's metrics, all worker processes added up"""
+    return app.response_class(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+# -------------------------
+# Admission Control
+# -------------------------
+# Routes that receive file content; the others are never turned away here
+UPLOAD_ENDPOINTS = {
+    "upload_file", "upload_batch", "upload_by_hash", "replace_file",
+    "create_upload_session", "patch_upload_session", "finalize_upload_session",
+}
+# Continuing a resumable upload that was admitted already spends no tokens
+RATE_LIMITED_ENDPOINTS = UPLOAD_ENDPOINTS - {"patch_upload_session", "finalize_upload_session"}
+# Bodies that are file content, so Content-Length is what the upload will add
+CONTENT_ENDPOINTS = {"upload_file", "upload_batch", "patch_upload_session"}
+
+# The server-wide count of uploads in flight, and each process's share of it
+# so the share of a process that died mid-upload can be given back
+IN_FLIGHT = "uploads_in_flight"
+IN_FLIGHT_HERE = f"{IN_FLIGHT}:{socket.gethostname()}:"
+
+def take_upload_token(client):
+    """Spend one of the client's tokens; returns 0, or the seconds until one is available
+
+    Refill and spend are one conditional UPDATE, so concurrent requests in
+    any process cannot spend the same token. Call inside a transaction.
+    """
+    rate, burst = app.config["UPLOAD_RATE"], app.config["UPLOAD_BURST"]
+    if not rate:
+        return 0
+    now = time.time()
+    level = RateBucket.tokens + (now - RateBucket.refilled) * rate
+    level = db.case((level > burst, burst), else_=level)
+    spend = (
+        db.update(RateBucket)
+        .where(RateBucket.client == client, level >= 1)
+        .values(tokens=level - 1, refilled=now)
+    )
+    if db.session.execute(spend).rowcount:
+        return 0
+    try:
+        with db.session.begin_nested():
+            db.session.add(RateBucket(client=client, tokens=burst - 1, refilled=now))
+        return 0
+    except IntegrityError:
+        pass  # the bucket exists and is empty
+    tokens, refilled = db.session.execute(
+        db.select(RateBucket.tokens, RateBucket.refilled).where(RateBucket.client == client)
+    ).one()
+    return max(1 - (tokens + (now - refilled) * rate), 0) / rate
+
+def prune_rate_buckets():
+    """Drop buckets idle long enough to have refilled; a full bucket is the same as none"""
+    rate, burst = app.config["UPLOAD_RATE"], app.config["UPLOAD_BURST"]
+    idle = time.time() - (burst / rate if rate else 0)
+    db.session.execute(db.delete(RateBucket).where(RateBucket.refilled < idle))
+
+@job_handler("prune_rate_buckets")
+def prune_rate_buckets_job():
+    prune_rate_buckets()
+    enqueue_job("prune_rate_buckets", delay=timedelta(minutes=10))
+
+def take_upload_slot(limit):
+    """Count one more upload in flight unless ``limit`` are already; call inside a transaction"""
+    claim = db.update(Counter).where(Counter.name == IN_FLIGHT, Counter.value < limit).values(
+        value=Counter.value + 1)
+    if not db.session.execute(claim).rowcount:
+        if read_counter(IN_FLIGHT) >= limit and not release_dead_slots():
+            return False
+        incr_counter(IN_FLIGHT)
+    incr_counter(f"{IN_FLIGHT_HERE}{os.getpid()}")
+    return True
+
+def release_dead_slots():
+    """Give back the slots of processes on this host that exited mid-upload; returns how many"""
+    released = 0
+    for name, count in db.session.execute(
+        db.select(Counter.name, Counter.value).where(Counter.name.startswith(IN_FLIGHT_HERE))
+    ).all():
+        try:
+            os.kill(int(name[len(IN_FLIGHT_HERE):]), 0)
+            continue
+        except ProcessLookupError:
+            pass
+        except PermissionError:
+            continue  # alive, under another user
+        db.session.execute(db.delete(Counter).where(Counter.name == name))
+        incr_counter(IN_FLIGHT, -count)
+        released += count
+    return released
+
+def reset_upload_slots():
+    """Forget every upload in flight; only when no worker process is running"""
+    db.session.execute(db.delete(Counter).where(Counter.name.startswith(f"{IN_FLIGHT}:")))
+    db.session.execute(db.delete(Counter).where(Counter.name == IN_FLIGHT))
+
+def shed(reason, status, message, retry_after=None):
+    UPLOADS_SHED.inc(reason=reason)
+    response = jsonify({"error": message})
+    response.status_code = status
+    if retry_after is not None:
+        response.headers["Retry-After"] = str(max(1, math.ceil(retry_after)))
+    return response
+
+@app.before_request
+def admit_upload():
+    """Turn away uploads over a limit before any of their body has been read"""
+    if request.endpoint not in UPLOAD_ENDPOINTS:
+        return None
+    if request.endpoint in RATE_LIMITED_ENDPOINTS:
+        wait = take_upload_token(request.remote_addr)
+        if wait:
+            db.session.rollback()
+            return shed("rate", 429, "Too many uploads; slow down", wait)
+
+    limit = app.config["MAX_UPLOADS_IN_FLIGHT"]
+    if limit and not take_upload_slot(limit):
+        db.session.commit()  # keep the spent token and any slots given back
+        return shed("busy", 503, "Server busy; retry shortly", app.config["ADMISSION_RETRY_AFTER"])
+    db.session.commit()
+    g.upload_slot = bool(limit)
+
+    if request.endpoint in CONTENT_ENDPOINTS:
+        problem = over_quota(current_owner(), request.content_length or 0)
+        if problem:
+            return shed("quota", problem[1], problem[0])
+    return None
+
+@app.teardown_request
+def release_upload_slot(exc):
+    if not g.pop("upload_slot", False):
+        return
+    db.session.rollback()  # whatever the request left uncommitted
+    try:
+        incr_counter(IN_FLIGHT, -1)
+        incr_counter(f"{IN_FLIGHT_HERE}{os.getpid()}", -1)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        app.logger.exception("Could not release an upload slot; it is kept until this process exits")
+
+@app.route("/usage", methods=["GET"])
+def usage():
+    """The caller's stored files and bytes against their quota"""
+    owner = current_owner()
+    return jsonify({
+        "files": read_counter(f"usage_files:{owner}"),
+        "bytes": read_counter(f"usage_bytes:{owner}"),
+        "quota_bytes": app.config["OWNER_QUOTA_BYTES"] or None,
+    })
+
+# -------------------------
+# Reconciliation
+# -------------------------
+# Findings that --repair leaves alone
+RECONCILE_REPORT_ONLY = {"unsharded_blob", "unsharded_root", "unowned_documents"}
+
+def in_prefix(column, prefix):
+    # Checksums are lowercase hex, so every one starting with ``prefix`` sorts
+    # below prefix + "g"; unlike LIKE, the range can use the column's index
+    return db.and_(column >= prefix, column < prefix + "g")
+
+def unlink_orphans(paths, cutoff):
+    """Remove files that are still older than ``cutoff`` when it comes to it"""
+    stale = []
+    for path in paths:
+        try:
+            if os.stat(path).st_mtime < cutoff:
+                stale.append(path)
         except FileNotFoundError:
             pass
-        db.session.delete(doc)
+    unlink_many(stale)
+
+def drop_documents(condition):
+    """Delete documents whose content is gone and tell their owners"""
+    by_owner = collections.defaultdict(list)
+    for doc_id, owner in db.session.execute(db.select(Document.id, Document.owner).where(condition)):
+        by_owner[owner].append(doc_id)
+    _, checksums, paths = release_documents(condition)
+    unlink_later(checksums, paths)
+    for owner, ids in by_owner.items():
+        publish_event(owner, "deleted", ids=ids)
+
+def reconcile_prefix(prefix, repair, findings):
+    """Check one top-level shard directory, content and derivatives, against the tables
+
+    Three range queries cover every blob and reference under the prefix,
+    however many files it holds.
+    """
+    cutoff = time.time() - app.config["RECONCILE_GRACE"].total_seconds()
+    files, orphans = {}, []
+    for name, path, mtime in blob_store().scan(prefix):
+        if HEX_SHA256.fullmatch(name):
+            files[name] = (path, mtime)
+        elif mtime < cutoff:
+            orphans.append(path)
+    derived = collections.defaultdict(list)
+    for name, path, mtime in derived_store().scan(prefix):
+        checksum = name.split("-", 1)[0]
+        if HEX_SHA256.fullmatch(checksum):
+            derived[checksum].append((path, mtime))
+        elif mtime < cutoff:
+            orphans.append(path)  # temp file of an interrupted render
+
+    # Listed before querying, so anything uploaded in between shows up as a
+    # row without a listed file and is checked on disk again below
+    blobs = {row.sha256: row for row in db.session.execute(
+        db.select(Blob.sha256, Blob.refcount, Blob.preview_status)
+        .where(in_prefix(Blob.sha256, prefix))
+    )}
+    refs = dict(db.session.execute(
+        db.select(Document.checksum, db.func.count())
+        .where(in_prefix(Document.checksum, prefix))
+        .group_by(Document.checksum)
+    ).all())
+
+    unrowed, lost, drifted, unrendered = [], [], [], []
+    for checksum, (path, mtime) in files.items():
+        if checksum in blobs:
+            continue
+        if checksum in refs:
+            unrowed.append(checksum)
+        elif mtime < cutoff:
+            orphans.append(path)
+    for checksum, blob in blobs.items():
+        if checksum not in files and not os.path.exists(blob_path(checksum)):
+            lost.append(checksum)
+            continue
+        if blob.refcount != refs.get(checksum, 0):
+            drifted.append(checksum)
+        if blob.preview_status == "ready" and len(derived.get(checksum, ())) < len(thumbnails.VARIANTS):
+            unrendered.append(checksum)
+    for checksum, entries in derived.items():
+        blob = blobs.get(checksum)
+        if blob is None or blob.preview_status != "ready":
+            orphans += [path for path, mtime in entries if mtime < cutoff]
+
+    findings += [("orphan_file", path) for path in orphans]
+    findings += [("missing_blob_row", f"{checksum} ({refs[checksum]} documents)") for checksum in unrowed]
+    findings += [("refcount_mismatch", f"{checksum} counts {blobs[checksum].refcount}, "
+                  f"{refs.get(checksum, 0)} documents") for checksum in drifted]
+    findings += [("missing_content", f"{checksum} ({refs.get(checksum, 0)} documents)") for checksum in lost]
+    findings += [("missing_preview", checksum) for checksum in unrendered]
+    if not repair:
+        return
+
+    unlink_orphans(orphans, cutoff)
+    if unrowed:
+        sizes = dict(db.session.execute(
+            db.select(Document.checksum, db.func.max(Document.size))
+            .where(Document.checksum.in_(unrowed))
+            .group_by(Document.checksum)
+        ).all())
+        for checksum in unrowed:
+            # Stored smaller than the documents say means it was gzipped on write
+            stored_size = os.path.getsize(files[checksum][0])
+            size = sizes[checksum] if sizes[checksum] is not None else stored_size
+            add_blob_ref(checksum, size, refs[checksum],
+                         "gzip" if stored_size != size else "identity", stored_size)
+    if drifted:
+        # Recounted inside the UPDATE, so references added since the read count too
+        actual = db.select(db.func.count()).where(Document.checksum == Blob.sha256).scalar_subquery()
+        db.session.execute(
+            db.update(Blob).where(Blob.sha256.in_(drifted)).values(refcount=actual)
+            .execution_options(synchronize_session=False)
+        )
+        unlink_later(delete_blobs(Blob.sha256.in_(drifted), Blob.refcount <= 0))
+    if lost:
+        drop_documents(Document.checksum.in_(lost))
+        delete_blobs(Blob.sha256.in_(lost))  # rows left over when the count had drifted
+    if unrendered:
+        db.session.execute(
+            db.update(Blob).where(Blob.sha256.in_(unrendered)).values(preview_status=None)
+            .execution_options(synchronize_session=False)
+        )
+        for checksum in unrendered:
+            enqueue_job("previews", {"checksum": checksum})
+
+def root_is_sharded():
+    """Whether `flask shard-uploads` has emptied UPLOAD_FOLDER of stored files
+
+    Until then the root can hold every file ever uploaded. With no such files
+    left, e.g. on a new install, that is recorded here too; listing stops at
+    the first file found.
+    """
+    if read_counter("root_sharded"):
+        return True
+    if next(blob_store().flat_files(), None) is not None:
+        return False
+    raise_counter("root_sharded", 1)
+    return True
+
+def reconcile_root(repair, findings):
+    """Check the files directly in UPLOAD_FOLDER, listing it once per pass
+
+    Only for a sharded root, which holds upload temp files and the odd
+    stray, so it is checked in a single step, in batches for the queries.
+    """
+    store = blob_store()
+    cutoff = time.time() - app.config["RECONCILE_GRACE"].total_seconds()
+    with os.scandir(store.root) as entries:
+        files = [entry for entry in entries if entry.is_file(follow_symlinks=False)]
+    size = app.config["RECONCILE_BATCH"]
+    for start in range(0, len(files), size):
+        check_root_files(store, files[start:start + size], cutoff, repair, findings)
+
+def check_root_files(store, batch, cutoff, repair, findings):
+    temp = [e.path for e in batch if e.name.startswith(".upload-") and e.name.endswith(".tmp")]
+    names = [e.name for e in batch if not e.name.startswith(".")]
+    has_blob = db.select(Blob.sha256).where(Blob.sha256 == Document.checksum).exists()
+    referenced = set(db.session.execute(
+        db.select(Document.filename).where(Document.filename.in_(names), ~has_blob)
+    ).scalars())
+    unsharded = set(db.session.execute(
+        db.select(Blob.sha256).where(Blob.sha256.in_([n for n in names if HEX_SHA256.fullmatch(n)]))
+    ).scalars())
+    orphans = temp + [store.legacy_path(n) for n in names if n not in referenced and n not in unsharded]
+    mtimes = {e.path: e.stat(follow_symlinks=False).st_mtime for e in batch}
+    orphans = [path for path in orphans if mtimes[path] < cutoff]
+
+    findings += [("orphan_file", path) for path in orphans]
+    # Report only: `flask shard-uploads` moves these where they belong
+    findings += [("unsharded_blob", store.legacy_path(n)) for n in sorted(unsharded)]
+    if repair:
+        unlink_orphans(orphans, cutoff)
+
+def reconcile_legacy_documents(after, repair, findings):
+    """Check documents without a blob row, one window of ids at a time
+
+    Returns the id to continue after, or None once past the newest document.
+    """
+    upto = after + app.config["RECONCILE_BATCH"]
+    has_blob = db.select(Blob.sha256).where(Blob.sha256 == Document.checksum).exists()
+    rows = db.session.execute(
+        db.select(Document.id, Document.filename, Document.checksum)
+        .where(Document.id > after, Document.id <= upto, ~has_blob)
+    ).all()
+    missing = [row.id for row in rows if not os.path.isfile(stored_path(row))]
+    findings += [("missing_content", f"document {doc_id}") for doc_id in missing]
+    if repair and missing:
+        drop_documents(Document.id.in_(missing))
+    newest = db.session.execute(db.select(db.func.max(Document.id))).scalar() or 0
+    return upto if upto < newest else None
+
+def reconcile_uploads(repair, findings):
+    """Match .partial files with resumable upload sessions, and count unowned documents"""
+    folder = os.path.join(app.config["UPLOAD_FOLDER"], ".partial")
+    cutoff = time.time() - app.config["RECONCILE_GRACE"].total_seconds()
+    with os.scandir(folder) as entries:
+        files = {e.name: e.stat(follow_symlinks=False).st_mtime
+                 for e in entries if e.is_file(follow_symlinks=False)}
+    # Sessions expire after UPLOAD_SESSION_TTL, so there are never many
+    sessions = dict(db.session.execute(db.select(UploadSession.id, UploadSession.offset)).all())
+
+    orphans = [partial_path(name) for name, mtime in files.items()
+               if name not in sessions and mtime < cutoff]
+    missing = [session_id for session_id, offset in sessions.items()
+               if offset and session_id not in files and not os.path.exists(partial_path(session_id))]
+    findings += [("orphan_file", path) for path in orphans]
+    findings += [("missing_partial", session_id) for session_id in missing]
+    if repair:
+        unlink_orphans(orphans, cutoff)
+        db.session.execute(db.delete(UploadSession).where(UploadSession.id.in_(missing)))
+
+    unowned = db.session.execute(
+        db.select(db.func.count()).select_from(Document).where(Document.owner.is_(None))
+    ).scalar()
+    if unowned:
+        # Report only: nobody can be told which session they belonged to
+        findings.append(("unowned_documents",
+                         f"{unowned} documents predate owner scoping; see LEGACY_CLAIM_TOKEN"))
+
+def reconcile_step(cursor, repair):
+    """Run the next bounded slice of a reconciliation pass
+
+    A pass checks each top-level shard prefix, then the files in the upload
+    folder root, then documents stored by name, then resumable uploads.
+    Start with ``cursor`` None; returns ``(cursor, findings)``, with a None
+    cursor once the pass is complete and findings as ``(kind, detail)``.
+    Repairs are left in the session for the caller to commit.
+    """
+    if app.config["UPLOAD_FANOUT_LEVELS"] < 1:
+        raise RuntimeError("Reconciliation needs the sharded layout; run `flask shard-uploads`")
+    cursor = cursor or {"phase": "blobs", "at": 0}
+    phase, at = cursor["phase"], cursor["at"]
+    findings = []
+    if phase == "blobs":
+        prefixes = blob_store().prefixes()
+        reconcile_prefix(prefixes[at], repair, findings)
+        cursor = {"phase": "blobs", "at": at + 1} if at + 1 < len(prefixes) else {"phase": "root", "at": ""}
+    elif phase == "root":
+        if root_is_sharded():
+            reconcile_root(repair, findings)
+        else:
+            # Listing an unsharded root in batches would cost a full scan per batch
+            findings.append(("unsharded_root", app.config["UPLOAD_FOLDER"]))
+        cursor = {"phase": "documents", "at": 0}
+    elif phase == "documents":
+        upto = reconcile_legacy_documents(at, repair, findings)
+        cursor = {"phase": "documents", "at": upto} if upto is not None else {"phase": "uploads", "at": None}
+    else:
+        reconcile_uploads(repair, findings)
+        cursor = None
+    for kind, _ in findings:
+        RECONCILE_FINDINGS.inc(kind=kind)
+    return cursor, findings
+
+@job_handler("reconcile")
+def reconcile_job(cursor=None, found=None):
+    """One step of a background pass; requeued after a pause so no run holds a worker long"""
+    found = collections.Counter(found)
+    cursor, findings = reconcile_step(cursor, app.config["RECONCILE_REPAIR"])
+    for kind, detail in findings:
+        app.logger.warning("Reconcile found %s: %s", kind, detail)
+    found.update(kind for kind, _ in findings)
+    if cursor is not None:
+        enqueue_job("reconcile", {"cursor": cursor, "found": found},
+                    delay=timedelta(seconds=app.config["RECONCILE_INTERVAL"]))
+    else:
+        app.logger.info("Reconcile pass complete: %s", dict(found) or "no findings")
+        if app.config["RECONCILE_PERIOD"]:
+            enqueue_job("reconcile", delay=app.config["RECONCILE_PERIOD"])
+
+# -------------------------
+# Maintenance Commands
+# -------------------------
+def init_storage(recover=True):
+    """One-time startup work: schema, upload folders, crashed-job recovery, pruning
+
+    Must run once per deployment start or reload, not per worker: the
+    production server does it in the master process before forking
+    (gunicorn.conf.py). ``recover=False`` leaves running jobs alone, for a
+    reload whose old workers may still be finishing them; the job lease
+    requeues any they abandon.
+    """
+    upgrade_schema()
+    os.makedirs(os.path.join(app.config["UPLOAD_FOLDER"], ".partial"), exist_ok=True)
+    # Failures used to be stored as tracebacks, which /jobs must not show
+    db.session.execute(db.update(Job).where(Job.last_error.startswith("Traceback")).values(
+        last_error="Error details are in the server log"))
+    if recover:
+        recover_jobs()
+        reset_upload_slots()
+        db.session.commit()
+    # Event ids come from this counter since it was introduced; continue past existing ones
+    newest = db.session.execute(db.select(db.func.max(Event.id))).scalar() or 0
+    raise_counter("event_seq", max(newest, read_counter("events_pruned")))
     db.session.commit()
-    return jsonify({"message": "All uploaded files removed (cancelled)"})
+    if db.session.get(Counter, "stored_bytes") is None:
+        recount_usage()  # first start since usage counters were introduced
+        db.session.commit()
+    schedule_recurring("prune_events")
+    schedule_recurring("prune_rate_buckets")
+    schedule_recurring("expire_uploads")
+    if app.config["RECONCILE_PERIOD"]:
+        schedule_recurring("reconcile")
+    else:
+        # Turned off since the last start: drop the queued pass as well
+        db.session.execute(db.delete(Job).where(Job.kind == "reconcile", Job.status == "pending"))
+        db.session.commit()
+
+@app.cli.command("init-db")
+@click.option("--reload", "reloading", is_flag=True,
+              help="Workers from the previous code are still running; do not requeue their jobs.")
+def init_db_command(reloading):
+    """Prepare the database and upload folder before starting the app."""
+    init_storage(recover=not reloading)
+    print(f"Initialized {db.engine.url.render_as_string()} and {app.config['UPLOAD_FOLDER']}")
+
+@app.cli.command("shard-uploads")
+@click.option("--dry-run", is_flag=True, help="Only report what would be moved.")
+def shard_uploads_command(dry_run):
+    """Move files from a flat UPLOAD_FOLDER into the sharded layout.
+
+    Run with the server stopped. Files already named by their sha256 are
+    moved to their shard directory. Files stored by name, from before
+    content addressing, are hashed and moved, and the documents that pointed
+    at them are linked to the resulting blob.
+    """
+    store = blob_store()
+    moved = adopted = 0
+    for name in list(store.flat_files()):
+        src = store.legacy_path(name)
+        if HEX_SHA256.fullmatch(name):
+            checksum = name
+            links = []
+        else:
+            size, checksum = hash_file(src, app.config["UPLOAD_CHUNK_SIZE"])
+            has_blob = db.select(Blob.sha256).where(Blob.sha256 == Document.checksum).exists()
+            links = Document.query.filter(Document.filename == name, ~has_blob).all()
+
+        print(f"{'would move' if dry_run else 'moving'} {name} -> {store.path(checksum)}"
+              + (f" ({len(links)} documents)" if links else ""))
+        if dry_run:
+            continue
+
+        store.put_file(src, checksum)
+        moved += 1
+        if links:
+            for doc in links:
+                doc.checksum = checksum
+                doc.size = size
+                doc.stored_size = size
+            add_blob_ref(checksum, size, len(links))
+            for owner in {doc.owner for doc in links}:
+                touch_documents(owner)
+            adopted += len(links)
+            db.session.commit()
+
+    if not dry_run:
+        raise_counter("root_sharded", 1)  # lets reconciliation check the root
+        db.session.commit()
+        print(f"Moved {moved} files; linked {adopted} legacy documents to blobs")
+
+@app.cli.command("generate-previews")
+def generate_previews_command():
+    """Queue thumbnail rendering for images stored before previews existed."""
+    if not thumbnails.available():
+        raise click.ClickException("Pillow is not installed")
+    pending = db.session.execute(
+        db.select(Blob.sha256, db.func.min(Document.filename))
+        .join(Document, Document.checksum == Blob.sha256)
+        .where(Blob.preview_status.is_(None))
+        .group_by(Blob.sha256)
+    ).all()
+    queued = 0
+    for checksum, filename in pending:
+        if thumbnails.is_image(filename):
+            enqueue_job("previews", {"checksum": checksum})
+            queued += 1
+    db.session.commit()
+    print(f"Queued previews for {queued} images")
+
+@app.cli.command("storage-report")
+def storage_report_command():
+    """Report logical versus stored bytes, i.e. what compression saves."""
+    logical, stored, count = db.session.execute(
+        db.select(db.func.sum(Document.size), db.func.sum(Document.stored_size), db.func.count())
+    ).one()
+    blob_logical, blob_stored, blobs = db.session.execute(
+        db.select(db.func.sum(Blob.size), db.func.sum(Blob.stored_size), db.func.count())
+    ).one()
+    by_encoding = db.session.execute(
+        db.select(Blob.encoding, db.func.count()).group_by(Blob.encoding)
+    ).all()
+    for label, n, logical_bytes, stored_bytes in [
+        ("documents", count, logical, stored),
+        ("blobs on disk", blobs, blob_logical, blob_stored),
+    ]:
+        logical_bytes, stored_bytes = logical_bytes or 0, stored_bytes or 0
+        saved = 1 - stored_bytes / logical_bytes if logical_bytes else 0
+        print(f"{label:<14} {n:>8}  logical {logical_bytes:>14,}  stored {stored_bytes:>14,}  saved {saved:.1%}")
+    print("encodings: " + ", ".join(f"{encoding or 'identity'}={n}" for encoding, n in by_encoding))
+
+@app.cli.command("recount-usage")
+def recount_usage_command():
+    """Rebuild the per-session and total storage usage counters from the tables."""
+    recount_usage()
+    db.session.commit()
+    print(f"Total stored bytes: {read_counter('stored_bytes'):,}")
+
+def save_reconcile_cursor(cursor):
+    path = app.config["RECONCILE_CURSOR"]
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(cursor, f)
+    os.replace(path + ".tmp", path)
+
+@app.cli.command("reconcile")
+@click.option("--repair", is_flag=True, help="Fix what is found instead of only reporting it.")
+@click.option("--restart", is_flag=True, help="Start a new pass instead of resuming an interrupted one.")
+@click.option("--pause", default=0.0, help="Seconds to sleep between steps, to go easy on a live server.")
+def reconcile_command(repair, restart, pause):
+    """Cross-check the upload folder against the database.
+
+    Reports files no row refers to, rows whose file is gone, and reference
+    counts that have drifted; --repair fixes them. Unreferenced files younger
+    than RECONCILE_GRACE are left alone, as they may belong to an upload in
+    progress. Progress is saved after every step, so an interrupted run
+    resumes where it stopped.
+    """
+    cursor = None
+    if not restart and os.path.exists(app.config["RECONCILE_CURSOR"]):
+        with open(app.config["RECONCILE_CURSOR"]) as f:
+            cursor = json.load(f)
+        print(f"Resuming at {cursor['phase']} {cursor['at']}")
+    found = collections.Counter()
+    while True:
+        cursor, findings = reconcile_step(cursor, repair)
+        db.session.commit()
+        for kind, detail in findings:
+            print(f"{kind}: {detail}")
+        found.update(kind for kind, _ in findings)
+        if cursor is None:
+            break
+        save_reconcile_cursor(cursor)
+        time.sleep(pause)
+    if os.path.exists(app.config["RECONCILE_CURSOR"]):
+        os.remove(app.config["RECONCILE_CURSOR"])
+    summary = ", ".join(f"{kind}={n}" for kind, n in sorted(found.items())) or "nothing"
+    print(f"Found {summary}")
+    if repair:
+        repaired = sum(n for kind, n in found.items() if kind not in RECONCILE_REPORT_ONLY)
+        print(f"Repaired {repaired}; {', '.join(sorted(RECONCILE_REPORT_ONLY))} are only reported")
 
 # -------------------------
 # Run App
 # -------------------------
 if __name__ == "__main__":
-    os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
-    app.run(debug=True)
+    # Development server only; production runs `gunicorn -c gunicorn.conf.py`
+    with app.app_context():
+        init_storage()
+    app.run(debug=os.environ.get("FLASK_DEBUG") == "1")
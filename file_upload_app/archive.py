@@ -0,0 +1,87 @@
+"""
+ZIP archives written on the fly while they are being sent.
+
+:func:`stream_zip` drives :mod:`zipfile` against a write-only sink and hands
+back whatever it wrote after every chunk, so an archive of any size is
+produced with one chunk of file data in memory at a time and nothing
+written to disk.
+"""
+
+import os
+import zipfile
+
+from storage import CHUNK_SIZE, is_compressible, open_stored
+
+
+class _Sink:
+    """Write-only file object; zipfile falls back to data descriptors for it"""
+
+    def __init__(self):
+        self._parts = []
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._parts)
+        self._parts.clear()
+        return data
+
+
+def unique_name(name, seen):
+    """``name``, or ``name (2)``, ``name (3)``... if it is already in the archive
+
+    Only the last path component is kept, so no member can be extracted
+    outside the target directory, whatever was stored as the name.
+    """
+    name = os.path.basename((name or "").replace("\\", "/"))
+    if name in ("", ".", ".."):
+        name = "unnamed"
+    stem, ext = os.path.splitext(name)
+    candidate, n = name, 1
+    while candidate in seen:
+        n += 1
+        candidate = f"{stem} ({n}){ext}"
+    seen.add(candidate)
+    return candidate
+
+
+def stream_zip(members, chunk_size=CHUNK_SIZE):
+    """Yield the bytes of a ZIP archive of ``members``.
+
+    ``members`` yields ``(name, path, encoding, size)`` for each file, where
+    ``encoding`` is how the file at ``path`` is stored and ``size`` is its
+    original length (None to take it from the file). Content that is
+    already compressed is stored as is; everything else is deflated. Files
+    that have disappeared by the time they are reached are left out.
+    """
+    sink = _Sink()
+    seen = set()
+    with zipfile.ZipFile(sink, "w") as archive:
+        for name, path, encoding, size in members:
+            try:
+                info = zipfile.ZipInfo.from_file(path, unique_name(name, seen), strict_timestamps=False)
+                src = open_stored(path, encoding)
+            except FileNotFoundError:
+                continue  # deleted or replaced since it was listed
+            with src:
+                head = src.read(chunk_size)
+                if size is not None:
+                    info.file_size = size  # decides whether the entry needs zip64
+                # A gzip blob was only stored compressed because deflate paid off
+                compressible = encoding == "gzip" or is_compressible(head)
+                info.compress_type = zipfile.ZIP_DEFLATED if compressible else zipfile.ZIP_STORED
+                with archive.open(info, "w") as dest:
+                    chunk = head
+                    while chunk:
+                        dest.write(chunk)
+                        data = sink.drain()
+                        if data:
+                            yield data
+                        chunk = src.read(chunk_size)
+            yield sink.drain()  # local header and data descriptor
+    yield sink.drain()  # central directory
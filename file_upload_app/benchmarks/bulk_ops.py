@@ -0,0 +1,115 @@
+"""
+Measure how /submit and /cancel scale with the size of the document table.
+
+Each size runs against a fresh temporary database and upload folder, so the
+real instance database is never touched. With --baseline the old
+row-at-a-time ORM implementation is timed as well for comparison.
+
+Both routes only touch the caller's documents. By default every seeded row
+belongs to the benchmark client (the worst case); with --owners N the rows
+are spread over N owners, so the client holds 1/N of the table.
+
+Run: python benchmarks/bulk_ops.py --sizes 1000,10000,100000 --baseline
+     python benchmarks/bulk_ops.py --sizes 1000000 --owners 100000
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+
+OWNER = "bench"
+
+
+def seed(app, db, Document, Blob, count, owners=1):
+    """Insert ``count`` pending documents, each with its own blob row
+
+    Row ``i`` belongs to OWNER when ``i % owners == 0`` and to another owner otherwise.
+    """
+    with app.app_context():
+        db.session.execute(db.delete(Document))
+        db.session.execute(db.delete(Blob))
+        checksums = [f"{i:064x}" for i in range(count)]
+        db.session.execute(
+            db.insert(Blob), [{"sha256": c, "size": 1, "refcount": 1} for c in checksums]
+        )
+        db.session.execute(
+            db.insert(Document),
+            [{"filename": f"file-{i}.txt", "status": "pending", "size": 1, "checksum": c,
+              "owner": OWNER if i % owners == 0 else f"other-{i % owners}"}
+             for i, c in enumerate(checksums)],
+        )
+        db.session.commit()
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+
+def baseline_submit(app, db, Document):
+    with app.app_context():
+        for doc in Document.query.filter_by(owner=OWNER).all():
+            doc.status = "saved"
+        db.session.commit()
+
+
+def baseline_cancel(app, db, Document):
+    with app.app_context():
+        for doc in Document.query.filter_by(owner=OWNER).all():
+            try:
+                os.remove(os.path.join(app.config["UPLOAD_FOLDER"], doc.filename))
+            except FileNotFoundError:
+                pass
+            db.session.delete(doc)
+        db.session.commit()
+
+
+def run(sizes, baseline, owners):
+    workdir = tempfile.mkdtemp(prefix="bulk-bench-")
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(workdir, "bench.db")
+    os.environ["UPLOAD_FOLDER"] = os.path.join(workdir, "uploads")
+    os.makedirs(os.environ["UPLOAD_FOLDER"], exist_ok=True)
+
+    from app import app, db, Blob, Document, init_storage
+
+    app.config["RECONCILE_PERIOD"] = None  # seeded rows have no files on disk
+    with app.app_context():
+        init_storage()
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session["owner"] = OWNER
+    print(f"{'rows':>8}  {'submit':>10}  {'cancel':>10}", end="")
+    print(f"  {'orm submit':>10}  {'orm cancel':>10}" if baseline else "")
+
+    for count in sizes:
+        seed(app, db, Document, Blob, count, owners)
+        submit, _ = timed(lambda: client.post("/submit"))
+        cancel, response = timed(lambda: client.post("/cancel"))
+        assert response.json["deleted"] == len(range(0, count, owners)), response.json
+        line = f"{count:>8}  {submit:>9.3f}s  {cancel:>9.3f}s"
+
+        if baseline:
+            seed(app, db, Document, Blob, count, owners)
+            orm_submit, _ = timed(lambda: baseline_submit(app, db, Document))
+            orm_cancel, _ = timed(lambda: baseline_cancel(app, db, Document))
+            line += f"  {orm_submit:>9.3f}s  {orm_cancel:>9.3f}s"
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="1000,10000,100000",
+                        help="comma-separated table sizes to measure")
+    parser.add_argument("--baseline", action="store_true",
+                        help="also time the old row-at-a-time implementation")
+    parser.add_argument("--owners", type=int, default=1,
+                        help="spread the rows over this many owners (the client is one of them)")
+    args = parser.parse_args()
+    run([int(n) for n in args.sizes.split(",")], args.baseline, args.owners)
@@ -0,0 +1,420 @@
+"""
+Load-test every route of the file upload app and record comparable results.
+
+The harness starts the app on a scratch database and upload folder, optionally
+pre-seeds the document table with many rows belonging to other owners, then
+drives each scenario at the requested concurrency as a single session. For
+every scenario it reports throughput, p50/p95/p99 latency, error count and the
+peak RSS of the server process tree. The results are written as JSON tagged
+with the current git commit, so runs can be compared across commits with
+--compare. Upload rate limits, the in-flight cap and quotas are switched off
+unless --admission is given, since a single client would only measure them.
+
+Examples (run from file_upload_app/):
+    python benchmarks/loadtest.py
+    python benchmarks/loadtest.py --seed-rows 100000 --concurrency 16 --requests 2000
+    python benchmarks/loadtest.py --sizes 1024:80,102400:15,450000:5 --scenarios upload,remove
+    python benchmarks/loadtest.py --compare benchmarks/results/old.json
+"""
+
+import argparse
+import base64
+import http.client
+import json
+import os
+import random
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.dirname(HERE)
+SCENARIOS = ["upload", "get_files", "remove", "submit", "cancel"]
+
+
+# -------------------------
+# Server
+# -------------------------
+def start_server(args, workdir):
+    """Start the app on a scratch database; returns the Popen handle"""
+    env = dict(os.environ)
+    env.update({
+        "DATABASE_URL": "sqlite:///" + os.path.join(workdir, "bench.db"),
+        "UPLOAD_FOLDER": os.path.join(workdir, "uploads"),
+        "BIND": f"127.0.0.1:{args.port}",
+        "WEB_CONCURRENCY": str(args.workers),
+        "THREADS": str(args.threads),
+        "ACCESS_LOG": os.devnull,
+        # Seeded rows have no files; a background pass would flag every one
+        # of them while requests are being measured
+        "RECONCILE_PERIOD": "0",
+    })
+    if not args.admission:
+        # One client driving many requests would otherwise just measure the limits
+        env.update({"UPLOAD_RATE": "0", "MAX_UPLOADS_IN_FLIGHT": "0", "OWNER_QUOTA_BYTES": "0"})
+    subprocess.run([sys.executable, "-m", "flask", "--app", "app", "init-db"],
+                   cwd=APP_DIR, env=env, check=True, stdout=subprocess.DEVNULL)
+    if args.seed_rows:
+        seed_rows(workdir, args.seed_rows)
+
+    if args.server == "gunicorn":
+        cmd = [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py"]
+    else:
+        cmd = [sys.executable, "-m", "flask", "--app", "app", "run", "--port", str(args.port),
+               "--with-threads", "--no-reload"]
+    log = open(os.path.join(workdir, "server.log"), "w")
+    server = subprocess.Popen(cmd, cwd=APP_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            status, _ = request(connect(args.port), "GET", "/jobs")
+            if status == 200:
+                return server
+        except OSError:
+            time.sleep(0.2)
+    stop_server(server)
+    raise SystemExit(f"Server did not come up; see {log.name}")
+
+
+def stop_server(server):
+    server.send_signal(signal.SIGTERM)
+    try:
+        server.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        server.kill()
+
+
+def seed_rows(workdir, count, status="saved", owner=None):
+    """Insert ``count`` documents (with blob rows) straight into the database
+
+    Without ``owner`` the rows are spread over 1000 other sessions.
+    """
+    conn = sqlite3.connect(os.path.join(workdir, "bench.db"))
+    start = conn.execute("SELECT coalesce(max(id), 0) FROM document").fetchone()[0]
+    checksums = [f"{start + i:064x}" for i in range(count)]
+    conn.executemany("INSERT OR IGNORE INTO blob (sha256, size, refcount) VALUES (?, 1, 1)",
+                     [(c,) for c in checksums])
+    conn.executemany(
+        "INSERT INTO document (filename, status, size, checksum, owner) VALUES (?, ?, 1, ?, ?)",
+        [(f"seed-{start + i}.txt", status, c, owner or f"seed-{i % 1000}")
+         for i, c in enumerate(checksums)],
+    )
+    conn.commit()
+    conn.close()
+
+
+def process_tree(root_pid):
+    """PIDs of ``root_pid`` and all its descendants (Linux /proc only)"""
+    parents = {}
+    for name in os.listdir("/proc"):
+        if name.isdigit():
+            try:
+                with open(f"/proc/{name}/stat") as f:
+                    parents[int(name)] = int(f.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                pass
+    tree, frontier = {root_pid}, [root_pid]
+    while frontier:
+        pid = frontier.pop()
+        children = [child for child, parent in parents.items() if parent == pid]
+        tree.update(children)
+        frontier.extend(children)
+    return tree
+
+
+def tree_rss(root_pid):
+    total = 0
+    for pid in process_tree(root_pid):
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    return total
+
+
+class RssSampler(threading.Thread):
+    """Track the peak resident memory of the server while a scenario runs"""
+
+    def __init__(self, pid, interval=0.2):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        if not os.path.isdir("/proc"):
+            return
+        while not self.stopped.is_set():
+            self.peak = max(self.peak, tree_rss(self.pid))
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        return self.peak or None
+
+
+# -------------------------
+# Client
+# -------------------------
+local = threading.local()
+# Every client thread shares one session, so the scoped routes see the same files
+session = {"cookie": None, "owner": None}
+
+
+def start_session(port):
+    """Get a session cookie from the server and read the owner id out of it"""
+    conn = connect(port)
+    conn.request("GET", "/get_files")
+    response = conn.getresponse()
+    response.read()
+    cookie = response.getheader("Set-Cookie").split(";", 1)[0]
+    # Flask session cookies are signed, not encrypted: base64 JSON, zlib'd if prefixed by "."
+    value = cookie.split("=", 1)[1]
+    payload = value.lstrip(".").split(".", 1)[0]
+    data = base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4))
+    if value.startswith("."):
+        data = zlib.decompress(data)
+    session.update(cookie=cookie, owner=json.loads(data)["owner"])
+
+
+def connect(port):
+    return http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+
+
+def request(conn, method, path, body=None, headers=None):
+    headers = dict(headers or {})
+    if session["cookie"]:
+        headers["Cookie"] = session["cookie"]
+    conn.request(method, path, body=body, headers=headers)
+    response = conn.getresponse()
+    return response.status, response.read()
+
+
+def timed_request(port, method, path, body=None, headers=None):
+    """Send one request on this thread's keep-alive connection; returns (status, seconds, body)"""
+    if getattr(local, "conn", None) is None:
+        local.conn = connect(port)
+    start = time.perf_counter()
+    try:
+        status, data = request(local.conn, method, path, body, headers)
+    except (OSError, http.client.HTTPException):
+        local.conn.close()
+        local.conn = None
+        return None, time.perf_counter() - start, b""
+    return status, time.perf_counter() - start, data
+
+
+def parse_sizes(spec):
+    """'1024:70,102400:30' -> ([1024, 102400], [70, 30])"""
+    sizes, weights = [], []
+    for part in spec.split(","):
+        size, _, weight = part.partition(":")
+        sizes.append(int(size))
+        weights.append(float(weight or 1))
+    return sizes, weights
+
+
+def draw_uploads(args, rng, count):
+    """``(size, payload_seed)`` for each of ``count`` uploads, drawn up front
+
+    Drawn on the main thread, so the size mix and payloads do not depend on
+    how the client threads happen to interleave.
+    """
+    sizes = rng.choices(*args.size_mix, k=count)
+    return [(size, rng.getrandbits(64)) for size in sizes]
+
+
+def upload_one(args, size, payload_seed):
+    body = random.Random(payload_seed).randbytes(size)
+    headers = {"Content-Type": "application/octet-stream", "X-Filename": f"bench-{size}.bin"}
+    return timed_request(args.port, "POST", "/upload", body, headers)
+
+
+# -------------------------
+# Scenarios
+# -------------------------
+def run_scenario(name, args, server, workdir):
+    """Run one scenario; returns its result record"""
+    rng = random.Random(args.seed)
+    ops = []
+    prepared = []
+
+    if name == "upload":
+        ops = [lambda drawn=drawn: upload_one(args, *drawn)
+               for drawn in draw_uploads(args, rng, args.requests)]
+    elif name == "get_files":
+        ops = [lambda: timed_request(args.port, "GET", "/get_files") for _ in range(args.requests)]
+    elif name == "remove":
+        # Upload the files to remove first; only the DELETEs are timed
+        for drawn in draw_uploads(args, rng, args.requests):
+            status, _, data = upload_one(args, *drawn)
+            if status == 200:
+                prepared.append(json.loads(data)["id"])
+        ops = [lambda i=i: timed_request(args.port, "DELETE", f"/remove/{i}") for i in prepared]
+    elif name == "submit":
+        ops = [lambda: timed_request(args.port, "POST", "/submit") for _ in range(args.requests)]
+    elif name == "cancel":
+        # /cancel empties the table, so every iteration re-seeds and runs serially
+        return run_cancel(args, server, workdir)
+
+    return drive(name, ops, args, server)
+
+
+def run_cancel(args, server, workdir):
+    latencies, errors = [], 0
+    sampler = RssSampler(server.pid)
+    sampler.start()
+    started = time.perf_counter()
+    for _ in range(args.cancel_rounds):
+        seed_rows(workdir, args.cancel_rows, status="pending", owner=session["owner"])
+        status, seconds, _ = timed_request(args.port, "POST", "/cancel")
+        latencies.append(seconds)
+        errors += status != 200
+    elapsed = time.perf_counter() - started
+    record = summarize("cancel", latencies, errors, elapsed, sampler.stop())
+    record["rows_per_cancel"] = args.cancel_rows
+    return record
+
+
+def drive(name, ops, args, server):
+    latencies, errors = [], 0
+    lock = threading.Lock()
+
+    def work(op):
+        nonlocal errors
+        status, seconds, _ = op()
+        with lock:
+            latencies.append(seconds)
+            errors += status is None or status >= 400
+
+    sampler = RssSampler(server.pid)
+    sampler.start()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(work, ops))
+    elapsed = time.perf_counter() - started
+    return summarize(name, latencies, errors, elapsed, sampler.stop())
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(name, latencies, errors, elapsed, peak_rss):
+    ordered = sorted(latencies)
+    return {
+        "scenario": name,
+        "requests": len(ordered),
+        "errors": errors,
+        "seconds": round(elapsed, 4),
+        "throughput_rps": round(len(ordered) / elapsed, 2) if elapsed else None,
+        "p50_ms": ms(percentile(ordered, 50)),
+        "p95_ms": ms(percentile(ordered, 95)),
+        "p99_ms": ms(percentile(ordered, 99)),
+        "max_ms": ms(ordered[-1] if ordered else None),
+        "peak_rss_bytes": peak_rss,
+    }
+
+
+def ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+# -------------------------
+# Reporting
+# -------------------------
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=APP_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def print_table(results, baseline=None):
+    previous = {r["scenario"]: r for r in (baseline or {}).get("results", [])}
+    print(f"{'scenario':<10} {'reqs':>6} {'err':>4} {'rps':>9} {'p50 ms':>9} {'p95 ms':>9} "
+          f"{'p99 ms':>9} {'peak RSS':>10}")
+    for r in results:
+        rss = f"{r['peak_rss_bytes'] / 2**20:.1f}M" if r["peak_rss_bytes"] else "-"
+        print(f"{r['scenario']:<10} {r['requests']:>6} {r['errors']:>4} {r['throughput_rps']:>9} "
+              f"{r['p50_ms']:>9} {r['p95_ms']:>9} {r['p99_ms']:>9} {rss:>10}")
+        old = previous.get(r["scenario"])
+        if old and old["throughput_rps"] and old["p95_ms"]:
+            print(f"{'':<10} vs {baseline['commit']}: rps {r['throughput_rps'] / old['throughput_rps']:.2f}x,"
+                  f" p95 {r['p95_ms'] / old['p95_ms']:.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help=f"comma-separated subset of {', '.join(SCENARIOS)}")
+    parser.add_argument("--server", choices=["gunicorn", "dev"], default="gunicorn")
+    parser.add_argument("--workers", type=int, default=2, help="server worker processes")
+    parser.add_argument("--threads", type=int, default=4, help="threads per worker")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--concurrency", type=int, default=8, help="client threads")
+    parser.add_argument("--requests", type=int, default=500, help="requests per scenario")
+    parser.add_argument("--sizes", default="1024:60,65536:30,450000:10",
+                        help="upload size mix as size:weight pairs")
+    parser.add_argument("--seed-rows", type=int, default=0,
+                        help="other sessions' documents to pre-seed before starting the server")
+    parser.add_argument("--cancel-rows", type=int, default=1000,
+                        help="documents seeded before each timed /cancel")
+    parser.add_argument("--cancel-rounds", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1, help="random seed for payloads")
+    parser.add_argument("--admission", action="store_true",
+                        help="keep the server's rate limits, in-flight cap and quotas on")
+    parser.add_argument("--output", help="JSON results path (default: benchmarks/results/)")
+    parser.add_argument("--compare", help="earlier results JSON to compare against")
+    args = parser.parse_args()
+    args.size_mix = parse_sizes(args.sizes)
+
+    workdir = tempfile.mkdtemp(prefix="loadtest-")
+    server = start_server(args, workdir)
+    try:
+        start_session(args.port)
+        results = []
+        for name in args.scenarios.split(","):
+            results.append(run_scenario(name.strip(), args, server, workdir))
+    finally:
+        stop_server(server)
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "config": {k: v for k, v in vars(args).items() if k not in ("size_mix", "compare", "output")},
+        "results": results,
+    }
+    output = args.output or os.path.join(
+        HERE, "results", f"{report['commit']}-{report['timestamp'].replace(':', '')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_table(results, baseline)
+    print(f"\nResults written to {output}")
+
+
+if __name__ == "__main__":
+    main()
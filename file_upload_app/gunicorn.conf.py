@@ -0,0 +1,110 @@
+"""
+Production server settings for the file upload app.
+
+Run from this directory:  gunicorn -c gunicorn.conf.py
+Graceful reload:          kill -HUP <master pid>
+
+Every value can be overridden from the environment, e.g.
+WEB_CONCURRENCY=8 THREADS=8 gunicorn -c gunicorn.conf.py
+"""
+
+import importlib.util
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+wsgi_app = "app:app"
+chdir = HERE
+bind = os.environ.get("BIND", "0.0.0.0:8000")
+
+# gevent (in requirements.txt) serves each connection as a greenlet, so open
+# /events streams and slow uploads cost no thread. SQLite calls still block
+# their worker while they run; they are short, and large finalize hashing and
+# compression is moved to a thread (see run_blocking in app.py).
+# WORKER_CLASS=gthread falls back to processes x threads, where every stream
+# holds a thread and is therefore capped at half of them.
+worker_class = os.environ.get("WORKER_CLASS", "gevent" if importlib.util.find_spec("gevent") else "gthread")
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get("THREADS", 4))
+worker_connections = int(os.environ.get("WORKER_CONNECTIONS", 2000))
+if worker_class == "gthread":
+    os.environ.setdefault("EVENTS_MAX_SUBSCRIBERS", str(max(threads // 2, 1)))
+else:
+    # Leave half the connections for ordinary requests
+    os.environ.setdefault("EVENTS_MAX_SUBSCRIBERS", str(max(worker_connections // 2, 1)))
+
+# Uploads beyond this many across all workers get 503 + Retry-After before their
+# body is read, so a burst of slow uploads cannot take every thread from
+# listings and downloads
+per_worker = max(threads - 1, 1) if worker_class == "gthread" else 64
+os.environ.setdefault("MAX_UPLOADS_IN_FLIGHT", str(workers * per_worker))
+
+# Kill workers stuck for longer than this; give in-flight requests time on reload
+timeout = int(os.environ.get("TIMEOUT", 30))
+graceful_timeout = int(os.environ.get("GRACEFUL_TIMEOUT", 30))
+keepalive = int(os.environ.get("KEEPALIVE", 5))
+
+# Recycle workers now and then so slow leaks cannot accumulate
+max_requests = int(os.environ.get("MAX_REQUESTS", 1000))
+max_requests_jitter = int(os.environ.get("MAX_REQUESTS_JITTER", 100))
+
+# /metrics adds up the snapshots every worker writes here, so a scrape through
+# the load balancer covers the whole server rather than one random worker
+os.environ.setdefault("METRICS_DIR", os.path.join(tempfile.gettempdir(), f"file-upload-metrics-{os.getpid()}"))
+
+accesslog = os.environ.get("ACCESS_LOG", "-")
+errorlog = "-"
+
+
+def init_db(*args):
+    """Run ``flask init-db`` in a child process so the master never imports the app.
+
+    Workers forked later then import the current code themselves and never
+    inherit database connections.
+    """
+    subprocess.run([sys.executable, "-m", "flask", "--app", "app", "init-db", *args], cwd=HERE, check=True)
+
+
+def on_starting(server):
+    """Create the schema and upload folders once, before any worker exists"""
+    init_db()
+    shutil.rmtree(os.environ["METRICS_DIR"], ignore_errors=True)  # totals restart with the server
+    os.makedirs(os.environ["METRICS_DIR"])
+
+
+def on_reload(server):
+    """Upgrade the schema for the new code before HUP forks its workers.
+
+    Old workers keep serving until they finish, so their running jobs are
+    left to the job lease rather than requeued. If the upgrade fails the
+    master exits rather than run the new code against the old schema.
+    """
+    init_db("--reload")
+
+
+def load_metrics():
+    """metrics.py loaded privately, so workers forked after a reload import it afresh"""
+    spec = importlib.util.spec_from_file_location("_master_metrics", os.path.join(HERE, "metrics.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def worker_exit(server, worker):
+    """Write the exiting worker's final metrics snapshot (runs in the worker)"""
+    if "metrics" in sys.modules:
+        sys.modules["metrics"].flush()
+
+
+def child_exit(server, worker):
+    """Keep an exited worker's counters in the /metrics totals"""
+    load_metrics().mark_process_dead(os.environ["METRICS_DIR"], worker.pid)
+
+
+def on_exit(server):
+    shutil.rmtree(os.environ["METRICS_DIR"], ignore_errors=True)
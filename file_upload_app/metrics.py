@@ -0,0 +1,286 @@
+"""
+Minimal Prometheus-style metrics kept in process memory.
+
+Counters, gauges and histograms with labels, rendered in the Prometheus text
+exposition format by :func:`render`.
+
+Each process keeps its own values. With several server processes, call
+:func:`share_values` with a directory they all use: every process then
+writes a snapshot of its values there every ``interval`` seconds, and
+:func:`render` adds up the snapshots of all of them, so any process answers
+a scrape for the whole server. When a process exits, :func:`mark_process_dead`
+(run by the process manager) folds its counters and histograms into an
+archive, so totals never go backwards; its gauges are dropped.
+"""
+
+import bisect
+import fcntl
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = []
+_lock = threading.Lock()
+_shared = {"dir": None, "interval": None, "pid": None}
+
+ARCHIVE = "archive.json"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        with _lock:
+            _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self, others=()):
+        """Text lines for this metric, with values from ``others`` snapshots added in"""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with _lock:
+            values = {key: _copy(value) for key, value in self._values.items()}
+        for snapshot in others:
+            for key, value in snapshot.get(self.name, {}).get("values", []):
+                key = tuple(key)
+                values[key] = _add(values[key], value) if key in values else value
+        lines.extend(self._render_items(sorted(values.items())))
+        return lines
+
+    def snapshot(self):
+        with _lock:
+            values = [[list(key), _copy(value)] for key, value in self._values.items()]
+        return {"kind": self.kind, "values": values}
+
+    def _render_items(self, items):
+        return [f"{self.name}{_labels(self.labelnames, key)} {_number(value)}" for key, value in items]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with _lock:
+            self._values[self._key(labels)] = value
+
+    def value(self, **labels):
+        with _lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with _lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0, 0.0]
+            if index < len(self.buckets):
+                state[0][index] += 1
+            state[1] += 1
+            state[2] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _render_items(self, items):
+        lines = []
+        for key, (counts, total, value_sum) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _labels(self.labelnames, key, [("le", _number(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _labels(self.labelnames, key, [("le", "+Inf")])
+            lines.append(f"{self.name}_bucket{labels} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_number(value_sum)}")
+        return lines
+
+
+def _copy(value):
+    if isinstance(value, list):  # histogram state: [bucket counts, count, sum]
+        return [list(value[0]), value[1], value[2]]
+    return value
+
+
+def _add(a, b):
+    if isinstance(a, list):
+        return [[x + y for x, y in zip(a[0], b[0])], a[1] + b[1], a[2] + b[2]]
+    return a + b
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _write(path, data):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f, separators=(",", ":"))
+    os.replace(tmp, path)
+
+
+def _snapshot():
+    with _lock:
+        metrics = list(_registry)
+    return {m.name: m.snapshot() for m in metrics}
+
+
+def flush():
+    """Write this process's snapshot now (e.g. just before it exits)"""
+    if _shared["dir"] is not None:
+        _write(os.path.join(_shared["dir"], f"{os.getpid()}.json"), _snapshot())
+
+
+def _flush_loop():
+    while True:
+        time.sleep(_shared["interval"])
+        try:
+            flush()
+        except OSError:
+            pass  # directory removed at shutdown; try again next time
+
+
+def _start_flusher():
+    if _shared["dir"] is None or _shared["pid"] == os.getpid():
+        return
+    _shared["pid"] = os.getpid()
+    threading.Thread(target=_flush_loop, name="metrics-flush", daemon=True).start()
+
+
+def share_values(path, interval=1.0):
+    """Aggregate metrics across every process that shares ``path``
+
+    Snapshots lag by up to ``interval`` seconds. Safe to call before forking:
+    each child starts its own writer.
+    """
+    os.makedirs(path, exist_ok=True)
+    _shared.update(dir=path, interval=interval)
+    _start_flusher()
+    os.register_at_fork(after_in_child=_start_flusher)
+
+
+def mark_process_dead(path, pid):
+    """Fold an exited process's counters and histograms into the archive
+
+    Needs nothing from the registry, so a supervisor that never records
+    metrics itself can call it.
+    """
+    source = os.path.join(path, f"{pid}.json")
+    snapshot = _read(source)
+    with open(os.path.join(path, ".lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        archive = _read(os.path.join(path, ARCHIVE))
+        totals = archive.setdefault("values", {})
+        for name, metric in snapshot.items():
+            if metric["kind"] == "gauge":
+                continue  # describes the process's present state, which is gone
+            merged = {tuple(key): value for key, value in totals.get(name, {}).get("values", [])}
+            for key, value in metric["values"]:
+                key = tuple(key)
+                merged[key] = _add(merged[key], value) if key in merged else value
+            totals[name] = {"kind": metric["kind"], "values": [[list(k), v] for k, v in merged.items()]}
+        # Readers skip pid files already folded in, until they are removed
+        live = {int(n.split(".")[0]) for n in os.listdir(path) if n.split(".")[0].isdigit()}
+        archive["merged"] = sorted(p for p in set(archive.get("merged", [])) | {pid} if p in live)
+        _write(os.path.join(path, ARCHIVE), archive)
+        try:
+            os.remove(source)
+        except FileNotFoundError:
+            pass
+
+
+def _other_snapshots():
+    path = _shared["dir"]
+    if path is None:
+        return []
+    # Process files before the archive: one folded in meanwhile is then listed
+    # as merged, rather than missing from both
+    by_pid = {}
+    for name in os.listdir(path):
+        stem, ext = os.path.splitext(name)
+        if ext == ".json" and stem.isdigit() and int(stem) != os.getpid():
+            by_pid[int(stem)] = _read(os.path.join(path, name))
+    archive = _read(os.path.join(path, ARCHIVE))
+    merged = set(archive.get("merged", []))
+    return [archive.get("values", {})] + [s for pid, s in by_pid.items() if pid not in merged]
+
+
+def render():
+    """Every registered metric in Prometheus text format, across processes if shared"""
+    with _lock:
+        metrics = list(_registry)
+    others = _other_snapshots()
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render(others))
+    return "\n".join(lines) + "\n"
+
+
+# Filesystem timings are recorded from storage.py, so they are defined here
+FS_SECONDS = Histogram(
+    "fs_operation_seconds",
+    "Latency of upload-folder file operations.",
+    ["op"],
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+)
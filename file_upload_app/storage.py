@@ -0,0 +1,389 @@
+import fcntl
+import gzip
+import hashlib
+import os
+import tempfile
+import uuid
+import zlib
+
+from metrics import FS_SECONDS
+
+CHUNK_SIZE = 64 * 1024
+SPOOL_SIZE = 512 * 1024
+
+
+class UploadTooLarge(Exception):
+    """Raised when a stream grows past the allowed size."""
+
+    def __init__(self, limit):
+        super().__init__(f"Upload exceeds {limit} bytes")
+        self.limit = limit
+
+
+# Leading bytes of formats that are already compressed; deflating them again
+# costs CPU for little or no gain
+COMPRESSED_SIGNATURES = (
+    b"\x1f\x8b",  # gzip
+    b"PK\x03\x04",  # zip, docx/xlsx/pptx, odf, jar, epub
+    b"\x89PNG",
+    b"\xff\xd8\xff",  # jpeg
+    b"GIF8",
+    b"BZh",
+    b"\xfd7zXZ",
+    b"7z\xbc\xaf",
+    b"Rar!",
+    b"\x28\xb5\x2f\xfd",  # zstd
+    b"%PDF",  # streams inside are usually deflated already
+    b"OggS",
+    b"ID3",
+    b"fLaC",
+    b"wOF2",
+)
+
+
+def is_compressible(head):
+    """Guess from the first bytes of a file whether deflate is worth trying"""
+    if head.startswith(COMPRESSED_SIGNATURES):
+        return False
+    if head[4:8] == b"ftyp":  # mp4, mov, heic, avif
+        return False
+    if head[:4] == b"RIFF" and head[8:12] in (b"WEBP", b"AVI "):
+        return False
+    # Unknown format: a quick trial on a sample catches random or encrypted data
+    sample = bytes(head[:4096])
+    return len(sample) < 256 or len(zlib.compress(sample, 1)) < len(sample) * 0.9
+
+
+def gzip_compressor(level):
+    return zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits 31 = gzip container
+
+
+def open_stored(path, encoding):
+    """Open a stored blob for reading its original bytes"""
+    if encoding == "gzip":
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+
+def compress_file(path, level=6, chunk_size=CHUNK_SIZE):
+    """Gzip ``path`` in place if it looks compressible and actually shrinks.
+
+    Returns ``(encoding, stored_size)``.
+    """
+    size = os.path.getsize(path)
+    with open(path, "rb") as src:
+        if not is_compressible(src.read(4096)):
+            return "identity", size
+        src.seek(0)
+        tmp_path = path + ".gz.tmp"
+        compressor = gzip_compressor(level)
+        with open(tmp_path, "wb") as out:
+            for chunk in iter(lambda: src.read(chunk_size), b""):
+                with FS_SECONDS.time(op="write"):
+                    out.write(compressor.compress(chunk))
+            out.write(compressor.flush())
+    stored_size = os.path.getsize(tmp_path)
+    if stored_size >= size:
+        os.remove(tmp_path)
+        return "identity", size
+    os.replace(tmp_path, path)
+    return "gzip", stored_size
+
+
+class StagedUpload:
+    """Bytes received from a stream, hashed and held until they are placed.
+
+    Small uploads stay in memory; anything past ``spool_size`` spills into a
+    temp file in ``folder`` so the final placement is a rename on the same
+    filesystem. Content that turns out to be a duplicate can be discarded
+    without ever having been written.
+
+    With ``compress_level`` set, content whose first chunk looks compressible
+    is gzipped on its way to disk; ``encoding`` and ``stored_size`` describe
+    what was written once :meth:`place` returns.
+    """
+
+    def __init__(self, folder, spool_size=SPOOL_SIZE, compress_level=None):
+        self.folder = folder
+        self.spool_size = spool_size
+        self.compress_level = compress_level
+        self.encoding = "identity"
+        self.stored_size = None
+        self.size = 0
+        self._compressor = None
+        self._digest = hashlib.sha256()
+        self._buffer = bytearray()
+        self._file = None
+        self._tmp_path = None
+
+    @property
+    def sha256(self):
+        return self._digest.hexdigest()
+
+    def write(self, chunk):
+        if self.size == 0 and self.compress_level is not None and is_compressible(chunk):
+            self.encoding = "gzip"
+        self.size += len(chunk)
+        self._digest.update(chunk)
+        if self._file is None and len(self._buffer) + len(chunk) <= self.spool_size:
+            self._buffer += chunk
+            return
+        if self._file is None:
+            self._spill()
+        self._write(chunk)
+
+    def _write(self, data):
+        if self._compressor is not None:
+            data = self._compressor.compress(data)
+        with FS_SECONDS.time(op="write"):
+            self._file.write(data)
+        self.stored_size += len(data)
+
+    def _spill(self, data=None):
+        fd, self._tmp_path = tempfile.mkstemp(dir=self.folder, prefix=".upload-", suffix=".tmp")
+        self._file = os.fdopen(fd, "wb")
+        self.stored_size = 0
+        if data is not None:
+            # Whole upload already compressed in memory
+            self._write(data)
+        else:
+            if self.encoding == "gzip":
+                self._compressor = gzip_compressor(self.compress_level)
+            self._write(self._buffer)
+        self._buffer = bytearray()
+
+    def place(self, dest):
+        """Atomically move the received bytes to ``dest``."""
+        if self._file is None:
+            data = bytes(self._buffer)
+            if self.encoding == "gzip":
+                # Everything is in memory, so only keep gzip if it actually helps
+                compressed = gzip.compress(data, self.compress_level)
+                if len(compressed) < len(data):
+                    data = compressed
+                else:
+                    self.encoding = "identity"
+            self._spill(data)
+        elif self._compressor is not None:
+            tail = self._compressor.flush()
+            self._compressor = None
+            with FS_SECONDS.time(op="write"):
+                self._file.write(tail)
+            self.stored_size += len(tail)
+        self._file.close()
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        with FS_SECONDS.time(op="rename"):
+            os.replace(self._tmp_path, dest)
+        self._tmp_path = None
+
+    def discard(self):
+        self._buffer = bytearray()
+        if self._file is not None:
+            self._file.close()
+        if self._tmp_path is not None:
+            unlink_quietly(self._tmp_path)
+            self._tmp_path = None
+
+
+class BlobStore:
+    """Content-addressed files under ``root``, fanned out by hash prefix.
+
+    With the default two levels, ``ab12cd...`` is stored at
+    ``root/ab/12/ab12cd...``, so no single directory grows past a few
+    thousand entries however many blobs there are.
+    """
+
+    def __init__(self, root, levels=2, width=2):
+        self.root = root
+        self.levels = levels
+        self.width = width
+
+    def path(self, checksum):
+        parts = [checksum[i * self.width:(i + 1) * self.width] for i in range(self.levels)]
+        return os.path.join(self.root, *parts, checksum)
+
+    def legacy_path(self, filename):
+        """Where files stored by name, before content addressing, live
+
+        Only the last component counts, so a name stored before filenames
+        were cleaned cannot point outside the root.
+        """
+        return os.path.join(self.root, os.path.basename(filename.replace("\\", "/")))
+
+    def exists(self, checksum):
+        return os.path.exists(self.path(checksum))
+
+    def touch(self, checksum):
+        """Refresh a blob's mtime before reusing it; returns False if there is no blob
+
+        Reconciliation only collects unreferenced files older than a grace
+        period, so this keeps it from removing content whose new reference
+        has not committed yet.
+        """
+        try:
+            os.utime(self.path(checksum))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def put_staged(self, staged, checksum):
+        """Place staged bytes as the blob, replacing any file already there
+
+        Whether the content is already stored is the caller's decision: a
+        file without a Blob row may be about to be unlinked.
+        """
+        staged.place(self.path(checksum))
+
+    def put_file(self, src, checksum, replace=False):
+        """Move a file into the store; unless ``replace``, dropped if the blob already exists"""
+        dest = self.path(checksum)
+        if not replace and self.touch(checksum):
+            with FS_SECONDS.time(op="unlink"):
+                os.remove(src)
+            return False
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        with FS_SECONDS.time(op="rename"):
+            os.replace(src, dest)
+        return True
+
+    def prefixes(self):
+        """Names of every possible top-level shard directory, in order"""
+        return [format(n, f"0{self.width}x") for n in range(16 ** self.width)]
+
+    def scan(self, prefix):
+        """Yield ``(name, path, mtime)`` for every file in the shard tree under ``prefix``"""
+        pending = [os.path.join(self.root, prefix)]
+        while pending:
+            try:
+                with os.scandir(pending.pop()) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            pending.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            yield entry.name, entry.path, entry.stat(follow_symlinks=False).st_mtime
+            except FileNotFoundError:
+                continue
+
+    def flat_files(self):
+        """Names of regular files sitting directly in the root (pre-sharding layout)"""
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False) and not entry.name.startswith("."):
+                    yield entry.name
+
+
+def receive_stream(stream, folder, max_size, chunk_size=CHUNK_SIZE, spool_size=SPOOL_SIZE,
+                   compress_level=None):
+    """Read ``stream`` into a :class:`StagedUpload` one chunk at a time.
+
+    Raises :class:`UploadTooLarge` as soon as more than ``max_size`` bytes
+    have arrived; nothing is left behind on disk in that case.
+    """
+    staged = StagedUpload(folder, spool_size, compress_level)
+    try:
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            if staged.size + len(chunk) > max_size:
+                raise UploadTooLarge(max_size)
+            staged.write(chunk)
+    except BaseException:
+        staged.discard()
+        raise
+    return staged
+
+
+def append_stream(stream, path, offset, max_size, chunk_size=CHUNK_SIZE):
+    """Write ``stream`` into ``path`` starting at ``offset``.
+
+    At most ``max_size`` bytes are accepted. Returns the number of bytes
+    written; the file is left truncated to the new end on success.
+    """
+    written = 0
+    mode = "r+b" if os.path.exists(path) else "wb"
+    with open(path, mode) as out:
+        out.seek(offset)
+        try:
+            while True:
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    break
+                written += len(chunk)
+                if written > max_size:
+                    raise UploadTooLarge(max_size)
+                with FS_SECONDS.time(op="write"):
+                    out.write(chunk)
+        except BaseException:
+            # Drop whatever this request added so the stored offset stays valid
+            out.truncate(offset)
+            raise
+        out.truncate(offset + written)
+    return written
+
+
+def try_lock(path):
+    """Open ``path`` holding an exclusive lock, or return None if it is held already.
+
+    Never waits, so a greenlet cannot stall its worker. Closing the returned
+    file releases the lock. Raises FileNotFoundError if there is no file.
+    """
+    f = open(path, "rb")
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        f.close()
+        return None
+    return f
+
+
+def hash_file(path, chunk_size=CHUNK_SIZE):
+    """Return ``(size, sha256_hex)`` for a file on disk."""
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            size += len(chunk)
+            digest.update(chunk)
+    return size, digest.hexdigest()
+
+
+def unlink_quietly(path):
+    """Remove ``path``, ignoring files that are already gone."""
+    try:
+        with FS_SECONDS.time(op="unlink"):
+            os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def move_aside(paths):
+    """Rename each existing file to a hidden name in its own directory; returns the new paths
+
+    A rename is a quick metadata change, so a file can be taken out of the
+    way under a lock and deleted after it is released. Anything left behind
+    by a crash is an orphan that reconciliation removes.
+    """
+    moved = []
+    for path in paths:
+        aside = os.path.join(os.path.dirname(path), f".unlink-{uuid.uuid4().hex}")
+        try:
+            with FS_SECONDS.time(op="rename"):
+                os.rename(path, aside)
+        except FileNotFoundError:
+            continue
+        moved.append(aside)
+    return moved
+
+
+def unlink_many(paths):
+    """Remove every path in ``paths``; returns how many files were deleted."""
+    removed = 0
+    for path in paths:
+        try:
+            with FS_SECONDS.time(op="unlink"):
+                os.remove(path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
@@ -0,0 +1,30 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# The app reads its database and upload folder at import time
+WORKDIR = tempfile.mkdtemp(prefix="file-upload-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(WORKDIR, 'test.db')}"
+os.environ["UPLOAD_FOLDER"] = os.path.join(WORKDIR, "uploads")
+os.environ["SECRET_KEY"] = "test"
+os.environ["PREVIEWS_ENABLED"] = "0"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app as flask_app, db, init_storage  # noqa: E402
+
+
+@pytest.fixture
+def app():
+    flask_app.config.update(TESTING=True, JOB_WORKERS=0, RECONCILE_PERIOD=None,
+                            UPLOAD_RATE=0, MAX_UPLOADS_IN_FLIGHT=0, COMPRESS_UPLOADS=False)
+    with flask_app.app_context():
+        db.drop_all()
+        init_storage()
+    yield flask_app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
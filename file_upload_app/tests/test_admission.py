@@ -0,0 +1,60 @@
+import io
+import os
+import subprocess
+import sys
+
+from app import IN_FLIGHT, IN_FLIGHT_HERE, RateBucket, db, incr_counter, read_counter
+
+
+def post_upload(client, content=b"data"):
+    return client.post("/upload", data={"file": (io.BytesIO(content), "x.txt")})
+
+
+def test_token_bucket_is_kept_in_the_database(app, client):
+    app.config.update(UPLOAD_RATE=0.01, UPLOAD_BURST=2)
+    assert post_upload(client, b"one").status_code == 200
+    assert post_upload(client, b"two").status_code == 200
+    response = post_upload(client, b"three")
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) > 1
+
+    # Every worker process reads the same bucket
+    with app.app_context():
+        bucket = db.session.get(RateBucket, "127.0.0.1")
+        assert bucket.tokens < 1
+
+
+def test_upload_slot_is_released_after_the_request(app, client):
+    app.config["MAX_UPLOADS_IN_FLIGHT"] = 1
+    assert post_upload(client, b"one").status_code == 200
+    assert post_upload(client, b"two").status_code == 200
+    with app.app_context():
+        assert read_counter(IN_FLIGHT) == 0
+
+
+def test_uploads_over_the_cap_are_shed(app, client):
+    app.config["MAX_UPLOADS_IN_FLIGHT"] = 1
+    with app.app_context():
+        # Another upload in a live process holds the only slot
+        incr_counter(IN_FLIGHT)
+        incr_counter(f"{IN_FLIGHT_HERE}{os.getpid()}")
+        db.session.commit()
+    response = post_upload(client)
+    assert response.status_code == 503
+    assert "Retry-After" in response.headers
+
+
+def test_slots_of_an_exited_process_are_given_back(app, client):
+    app.config["MAX_UPLOADS_IN_FLIGHT"] = 2
+    exited = subprocess.run([sys.executable, "-c", "import os; print(os.getpid())"],
+                            capture_output=True, text=True, check=True)
+    with app.app_context():
+        # A worker was killed while it held both slots
+        incr_counter(IN_FLIGHT, 2)
+        incr_counter(f"{IN_FLIGHT_HERE}{int(exited.stdout)}", 2)
+        db.session.commit()
+
+    assert post_upload(client).status_code == 200
+    with app.app_context():
+        assert read_counter(IN_FLIGHT) == 0
+        assert read_counter(f"{IN_FLIGHT_HERE}{int(exited.stdout)}") == 0
@@ -0,0 +1,25 @@
+import io
+
+from app import upload_limit
+
+
+def test_batch_stores_every_file_that_fits(app, client):
+    with app.app_context():
+        too_big = b"x" * (upload_limit("batch") + 1)
+    response = client.post("/upload_batch", data={"files": [
+        (io.BytesIO(b"one"), "a.txt"), (io.BytesIO(too_big), "big.bin"), (io.BytesIO(b"two"), "b.txt")]})
+    assert response.status_code == 200
+    assert (response.json["uploaded"], response.json["failed"]) == (2, 1)
+
+    a, big, b = response.json["files"]
+    assert "error" in big and "id" not in big
+    assert client.get(f"/files/{a['id']}").data == b"one"
+    assert client.get(f"/files/{b['id']}").data == b"two"
+    assert [f["filename"] for f in client.get("/get_files").json] == ["a.txt", "b.txt"]
+
+
+def test_batch_over_the_file_count_is_refused(app, client):
+    files = [(io.BytesIO(b"x"), f"{n}.txt") for n in range(app.config["MAX_BATCH_FILES"] + 1)]
+    assert client.post("/upload_batch", data={"files": files}).status_code == 400
+    assert client.post("/upload_batch", data={}).status_code == 400
+    assert client.get("/get_files").json == []
@@ -0,0 +1,98 @@
+import gzip
+import io
+
+from app import Blob, Document, db
+
+TEXT = b"".join(b"line %05d of a compressible file\n" % n for n in range(2000))
+
+
+def upload(client, content, name="notes.txt"):
+    response = client.post("/upload", data={"file": (io.BytesIO(content), name)})
+    assert response.status_code == 200, response.json
+    return response.json["id"]
+
+
+def test_range_on_gzip_stored_blob_without_accept_encoding(app, client):
+    app.config["COMPRESS_UPLOADS"] = True
+    file_id = upload(client, TEXT)
+    with app.app_context():
+        checksum = db.session.get(Document, file_id).checksum
+        assert db.session.get(Blob, checksum).encoding == "gzip"
+
+    response = client.get(f"/files/{file_id}", headers={"Range": "bytes=1000-1999"})
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == f"bytes 1000-1999/{len(TEXT)}"
+    assert "Content-Encoding" not in response.headers
+    assert response.data == TEXT[1000:2000]
+
+    full = client.get(f"/files/{file_id}")
+    assert full.headers["Accept-Ranges"] == "bytes"
+    assert full.data == TEXT
+
+
+def test_range_request(client):
+    file_id = upload(client, TEXT)
+    response = client.get(f"/files/{file_id}", headers={"Range": "bytes=-10"})
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == f"bytes {len(TEXT) - 10}-{len(TEXT) - 1}/{len(TEXT)}"
+    assert response.data == TEXT[-10:]
+
+    unsatisfiable = client.get(f"/files/{file_id}", headers={"Range": f"bytes={len(TEXT)}-"})
+    assert unsatisfiable.status_code == 416
+
+
+def test_etag_and_last_modified_revalidate(client):
+    file_id = upload(client, TEXT)
+    first = client.get(f"/files/{file_id}")
+    etag, modified = first.headers["ETag"], first.headers["Last-Modified"]
+
+    assert client.get(f"/files/{file_id}", headers={"If-None-Match": etag}).status_code == 304
+    assert client.get(f"/files/{file_id}", headers={"If-Modified-Since": modified}).status_code == 304
+    # A range that no longer matches the ETag gets the whole current file
+    stale = client.get(f"/files/{file_id}", headers={"Range": "bytes=0-9", "If-Range": '"other"'})
+    assert stale.status_code == 200 and stale.data == TEXT
+
+
+def test_gzip_blob_is_sent_compressed_to_clients_that_accept_it(app, client):
+    app.config["COMPRESS_UPLOADS"] = True
+    file_id = upload(client, TEXT)
+
+    response = client.get(f"/files/{file_id}", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.headers["ETag"].strip('"').endswith("-gzip")
+    assert "Accept-Encoding" in response.headers["Vary"]
+    assert gzip.decompress(response.data) == TEXT
+
+    plain = client.get(f"/files/{file_id}")
+    assert "Content-Encoding" not in plain.headers
+    assert plain.data == TEXT
+    assert client.get(f"/files/{file_id}", headers={"If-None-Match": plain.headers["ETag"]}).status_code == 304
+
+
+def test_download_is_an_attachment_on_request(client):
+    file_id = upload(client, b"x", "résumé.txt")
+    disposition = client.get(f"/files/{file_id}?download=1").headers["Content-Disposition"]
+    assert disposition.startswith("attachment;")
+    assert "filename*=UTF-8''r%C3%A9sum%C3%A9.txt" in disposition
+
+
+def test_other_owners_files_are_not_found(app, client):
+    file_id = upload(client, TEXT)
+    assert app.test_client().get(f"/files/{file_id}").status_code == 404
+
+
+def test_replace_keeps_the_id_and_serves_new_content(client):
+    file_id = upload(client, b"old content", "a.txt")
+    etag = client.get(f"/files/{file_id}").headers["ETag"]
+
+    response = client.put(f"/files/{file_id}", data=b"new content", headers={
+        "Content-Type": "application/octet-stream", "If-Match": etag})
+    assert response.status_code == 200
+    assert response.json["id"] == file_id and response.json["filename"] == "a.txt"
+    assert client.get(f"/files/{file_id}").data == b"new content"
+
+    # The old ETag no longer matches
+    conflict = client.put(f"/files/{file_id}", data=b"newer", headers={
+        "Content-Type": "application/octet-stream", "If-Match": etag})
+    assert conflict.status_code == 412
+    assert client.get(f"/files/{file_id}").data == b"new content"
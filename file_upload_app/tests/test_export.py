@@ -0,0 +1,43 @@
+import io
+import zipfile
+
+from app import Document, db
+
+
+def upload(client, content, name):
+    response = client.post("/upload", data={"file": (io.BytesIO(content), name)})
+    assert response.status_code == 200, response.json
+    return response.json["id"]
+
+
+def test_stored_names_with_directory_parts_cannot_escape_the_archive(app, client):
+    traversal = upload(client, b"one", "a.txt")
+    upload(client, b"two", "hostname")
+    with app.app_context():
+        # A row stored before uploaded names were cleaned
+        db.session.get(Document, traversal).filename = "../../../../etc/hostname"
+        db.session.commit()
+
+    archive = zipfile.ZipFile(io.BytesIO(client.get("/export").data))
+    assert archive.namelist() == ["hostname", "hostname (2)"]
+    assert archive.read("hostname") == b"one"
+
+
+def test_export_holds_every_file_and_filters_by_status(app, client):
+    saved = upload(client, b"saved content", "notes.txt")
+    upload(client, b"pending content", "notes.txt")
+    with app.app_context():
+        db.session.get(Document, saved).status = "saved"
+        db.session.commit()
+
+    response = client.get("/export")
+    assert response.mimetype == "application/zip"
+    archive = zipfile.ZipFile(io.BytesIO(response.data))
+    assert archive.namelist() == ["notes.txt", "notes (2).txt"]
+    assert archive.read("notes.txt") == b"saved content"
+    assert archive.read("notes (2).txt") == b"pending content"
+
+    archive = zipfile.ZipFile(io.BytesIO(client.get("/export?status=saved").data))
+    assert archive.namelist() == ["notes.txt"]
+    # Other owners get an empty archive
+    assert zipfile.ZipFile(io.BytesIO(app.test_client().get("/export").data)).namelist() == []
@@ -0,0 +1,57 @@
+import io
+
+import pytest
+
+from app import Document, clean_filename, db
+from storage import BlobStore
+
+TRAVERSAL = "../../../../etc/hostname"
+
+
+def stored_names(app):
+    with app.app_context():
+        return sorted(db.session.execute(db.select(Document.filename)).scalars())
+
+
+@pytest.mark.parametrize("raw, clean", [
+    (TRAVERSAL, "hostname"),
+    ("/etc/passwd", "passwd"),
+    ("..\\..\\boot.ini", "boot.ini"),
+    ("..", ""),
+    ("dir/", ""),
+    ("report.pdf", "report.pdf"),
+])
+def test_clean_filename(raw, clean):
+    assert clean_filename(raw) == clean
+
+
+def test_multipart_upload_drops_directory_parts(app, client):
+    response = client.post("/upload", data={"file": (io.BytesIO(b"one"), TRAVERSAL)})
+    assert response.json["filename"] == "hostname"
+    assert stored_names(app) == ["hostname"]
+
+
+def test_batch_upload_drops_directory_parts(app, client):
+    response = client.post("/upload_batch", data={"files": [
+        (io.BytesIO(b"one"), TRAVERSAL), (io.BytesIO(b"two"), "..")]})
+    assert response.status_code == 200
+    assert [f["filename"] for f in response.json["files"]] == ["hostname"]
+    assert stored_names(app) == ["hostname"]
+
+
+def test_replace_drops_directory_parts(app, client):
+    file_id = client.post("/upload", data={"file": (io.BytesIO(b"one"), "a.txt")}).json["id"]
+    response = client.put(f"/files/{file_id}", data={"file": (io.BytesIO(b"two"), TRAVERSAL)})
+    assert response.status_code == 200
+    assert stored_names(app) == ["hostname"]
+
+
+def test_raw_upload_header_is_cleaned(app, client):
+    response = client.post("/upload", data=b"raw", headers={
+        "Content-Type": "application/octet-stream", "X-Filename": "..%2F..%2Fetc%2Fhostname"})
+    assert response.json["filename"] == "hostname"
+
+
+def test_legacy_names_stay_inside_the_root():
+    # Rows stored before names were cleaned can still hold directory parts
+    assert BlobStore("/srv/uploads").legacy_path(TRAVERSAL) == "/srv/uploads/hostname"
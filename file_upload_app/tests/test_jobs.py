@@ -0,0 +1,102 @@
+import io
+import os
+from datetime import timedelta
+
+from app import Blob, Counter, Document, Job, JOB_HANDLERS, blob_path, db, run_next_job, utcnow
+
+
+def run_jobs(app):
+    with app.app_context():
+        while run_next_job():
+            pass
+
+
+def upload(client, content, name="x.txt"):
+    response = client.post("/upload", data={"file": (io.BytesIO(content), name)})
+    assert response.status_code == 200, response.json
+    return response.json["id"]
+
+
+def test_reupload_before_unlink_job_keeps_content(app, client):
+    """Remove, then re-add the same file while the unlink job is still queued"""
+    first = upload(client, b"same content")
+    assert client.delete(f"/remove/{first}").status_code == 200
+    second = upload(client, b"same content")
+
+    run_jobs(app)
+
+    response = client.get(f"/files/{second}")
+    assert response.status_code == 200
+    assert response.data == b"same content"
+
+
+def test_unlink_job_removes_released_content(app, client):
+    file_id = upload(client, b"short-lived")
+    with app.app_context():
+        path = blob_path(db.session.get(Document, file_id).checksum)
+    assert client.delete(f"/remove/{file_id}").status_code == 200
+    assert os.path.exists(path)  # deferred until the job runs
+
+    run_jobs(app)
+
+    assert not os.path.exists(path)
+    with app.app_context():
+        assert db.session.execute(db.select(Blob)).first() is None
+
+
+def test_job_left_running_by_exited_worker_is_reclaimed(app):
+    with app.app_context():
+        stale = utcnow() - app.config["JOB_LEASE"] - timedelta(seconds=1)
+        db.session.add(Job(kind="unlink", payload={"paths": []}, status="running",
+                           attempts=1, claimed_at=stale))
+        db.session.add(Job(kind="unlink", payload={"paths": []}, status="running",
+                           attempts=1, claimed_at=utcnow()))
+        db.session.commit()
+
+        while run_next_job():
+            pass
+        remaining = db.session.execute(db.select(Job.status, Job.claimed_at).where(Job.kind == "unlink")).all()
+    assert len(remaining) == 1 and remaining[0].claimed_at > stale
+
+
+def test_unlink_job_works_in_small_batches(app, client):
+    app.config["UNLINK_BATCH"], batch = 2, app.config["UNLINK_BATCH"]
+    try:
+        for n in range(5):
+            upload(client, b"content %d" % n, f"{n}.txt")
+        with app.app_context():
+            paths = [blob_path(c) for c in db.session.execute(db.select(Blob.sha256)).scalars()]
+        assert client.post("/cancel").json["files_to_unlink"] == 5
+        with app.app_context():
+            payload = db.session.execute(db.select(Job.payload).where(Job.kind == "unlink")).scalar()
+        # Previews were never rendered, so no derivative paths are looked up
+        assert len(payload["checksums"]) == 5 and payload["rendered"] == []
+
+        run_jobs(app)
+
+        assert not any(os.path.exists(path) for path in paths)
+        leftovers = [name for path in paths for name in os.listdir(os.path.dirname(path))]
+        assert leftovers == []  # nothing renamed aside and forgotten
+        with app.app_context():
+            assert db.session.execute(db.select(Blob)).first() is None
+    finally:
+        app.config["UNLINK_BATCH"] = batch
+
+
+def test_failed_job_error_shows_no_statement_parameters(app, client):
+    def insert_twice(name):
+        db.session.execute(db.insert(Counter), [{"name": name, "value": 1}] * 2)
+
+    JOB_HANDLERS["insert_twice"] = insert_twice
+    try:
+        with app.app_context():
+            # On its last attempt, so it is listed among the failures
+            db.session.add(Job(kind="insert_twice", payload={"name": "secret-checksum"},
+                               attempts=app.config["JOB_MAX_ATTEMPTS"] - 1))
+            db.session.commit()
+        run_jobs(app)
+    finally:
+        del JOB_HANDLERS["insert_twice"]
+
+    failures = client.get("/jobs").json["recent_failures"]
+    assert [f["error"] for f in failures] == ["IntegrityError: UNIQUE constraint failed: counter.name"]
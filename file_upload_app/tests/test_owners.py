@@ -0,0 +1,42 @@
+from app import Document, db
+
+
+def start_upload(client, content=b"resumable"):
+    response = client.post("/uploads", json={"filename": "r.txt", "length": len(content)})
+    assert response.status_code == 201
+    return response.json["id"]
+
+
+def test_upload_session_is_hidden_from_other_owners(app, client):
+    session_id = start_upload(client)
+    other = app.test_client()
+
+    assert other.get(f"/uploads/{session_id}").status_code == 404
+    response = other.patch(f"/uploads/{session_id}", data=b"resumable",
+                           headers={"Upload-Offset": "0"})
+    assert response.status_code == 404
+    assert other.post(f"/uploads/{session_id}/finalize").status_code == 404
+    assert other.delete(f"/uploads/{session_id}").status_code == 404
+
+    assert client.get(f"/uploads/{session_id}").json["offset"] == 0
+
+
+def test_legacy_documents_are_claimed_with_the_token(app, client):
+    app.config["LEGACY_CLAIM_TOKEN"] = "let-me-in"
+    with app.app_context():
+        db.session.add_all([Document(filename=f"old{n}.txt", size=10, status="saved") for n in range(3)])
+        db.session.commit()
+
+    assert client.post("/claim_legacy", json={"token": "wrong"}).status_code == 404
+    response = client.post("/claim_legacy", json={"token": "let-me-in"})
+    assert response.json["claimed"] == 3
+
+    assert [f["filename"] for f in client.get("/get_files").json] == ["old0.txt", "old1.txt", "old2.txt"]
+    assert client.get("/usage").json["bytes"] == 30
+    # Nothing is left for a second caller
+    assert app.test_client().post("/claim_legacy", json={"token": "let-me-in"}).json["claimed"] == 0
+
+
+def test_legacy_claim_does_not_exist_without_a_token(app, client):
+    app.config["LEGACY_CLAIM_TOKEN"] = None
+    assert client.post("/claim_legacy", json={"token": ""}).status_code == 404
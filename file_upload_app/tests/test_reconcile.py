@@ -0,0 +1,53 @@
+import os
+import time
+from datetime import timedelta
+
+from app import Job, db, init_storage, reconcile_step
+
+ROOT_PHASE = {"phase": "root", "at": ""}
+
+
+def put_flat_file(app, name, age=0):
+    path = os.path.join(app.config["UPLOAD_FOLDER"], name)
+    with open(path, "wb") as f:
+        f.write(b"stored by name")
+    os.utime(path, (time.time() - age, time.time() - age))
+    return path
+
+
+def test_unsharded_root_is_reported_not_listed(app):
+    stray = put_flat_file(app, "report.pdf", age=86400)
+    try:
+        with app.app_context():
+            cursor, findings = reconcile_step(ROOT_PHASE, repair=False)
+        assert findings == [("unsharded_root", app.config["UPLOAD_FOLDER"])]
+        assert cursor == {"phase": "documents", "at": 0}
+    finally:
+        os.remove(stray)
+
+
+def test_root_is_checked_in_one_step_once_sharded(app):
+    app.config["RECONCILE_BATCH"], batch = 2, app.config["RECONCILE_BATCH"]
+    assert app.test_cli_runner().invoke(args=["shard-uploads"]).exit_code == 0
+    strays = [put_flat_file(app, f".upload-{n}.tmp", age=86400) for n in range(5)]
+    try:
+        with app.app_context():
+            cursor, findings = reconcile_step(ROOT_PHASE, repair=True)
+        assert sorted(findings) == [("orphan_file", path) for path in sorted(strays)]
+        assert cursor == {"phase": "documents", "at": 0}
+        assert not any(os.path.exists(path) for path in strays)
+    finally:
+        app.config["RECONCILE_BATCH"] = batch
+
+
+def test_disabling_the_period_drops_the_queued_pass(app):
+    def queued():
+        return db.session.execute(db.select(db.func.count()).where(Job.kind == "reconcile")).scalar()
+
+    with app.app_context():
+        app.config["RECONCILE_PERIOD"] = timedelta(days=1)
+        init_storage()
+        assert queued() == 1
+        app.config["RECONCILE_PERIOD"] = None
+        init_storage()
+        assert queued() == 0
@@ -0,0 +1,61 @@
+import os
+from datetime import timedelta
+
+from app import UploadSession, db, partial_path, run_next_job, utcnow
+from storage import try_lock
+
+
+def start_upload(client, length=None):
+    response = client.post("/uploads", json={"filename": "r.bin", "length": length})
+    assert response.status_code == 201
+    return response.json["id"]
+
+
+def patch(client, session_id, offset, data, **kwargs):
+    return client.patch(f"/uploads/{session_id}", data=data,
+                        headers={"Upload-Offset": str(offset)}, **kwargs)
+
+
+def test_stale_offset_is_rejected_without_touching_received_bytes(app, client):
+    session_id = start_upload(client)
+    assert patch(client, session_id, 0, b"first").headers["Upload-Offset"] == "5"
+
+    response = patch(client, session_id, 0, b"again")
+    assert response.status_code == 409
+    assert response.headers["Upload-Offset"] == "5"
+    with open(partial_path(session_id), "rb") as f:
+        assert f.read() == b"first"
+
+
+def test_chunk_arriving_while_another_is_written_gets_409(app, client):
+    session_id = start_upload(client)
+    with try_lock(partial_path(session_id)):  # a PATCH in another request
+        response = patch(client, session_id, 0, b"racing")
+        assert response.status_code == 409
+        assert client.post(f"/uploads/{session_id}/finalize").status_code == 409
+    assert patch(client, session_id, 0, b"racing").status_code == 200
+
+
+def test_chunk_of_exactly_the_limit_is_accepted_behind_gunicorn(app, client):
+    app.config["RESUMABLE_CHUNK_LIMIT"] = 1024
+    try:
+        session_id = start_upload(client)
+        # gunicorn marks its input terminated, which makes Werkzeug enforce the cap on reads
+        response = patch(client, session_id, 0, b"x" * 1024,
+                         environ_overrides={"wsgi.input_terminated": True})
+        assert response.status_code == 200
+        assert response.headers["Upload-Offset"] == "1024"
+        assert patch(client, session_id, 1024, b"x" * 1025).status_code == 400
+    finally:
+        app.config["RESUMABLE_CHUNK_LIMIT"] = 4 * 1024 * 1024
+
+
+def test_abandoned_sessions_are_expired_by_the_job(app, client):
+    session_id = start_upload(client)
+    with app.app_context():
+        db.session.get(UploadSession, session_id).updated_at = utcnow() - timedelta(days=2)
+        db.session.commit()
+        while run_next_job():
+            pass
+        assert db.session.get(UploadSession, session_id) is None
+    assert not os.path.exists(partial_path(session_id))
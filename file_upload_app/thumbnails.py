@@ -0,0 +1,72 @@
+"""
+Image derivatives (thumbnail and preview) for uploaded files.
+
+:func:`render_derivatives` is CPU-bound and is meant to run in a process
+pool, so it only takes and returns plain values and imports nothing from the
+Flask app.
+"""
+
+import os
+import tempfile
+
+from storage import open_stored
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # previews are skipped when Pillow is not installed
+    Image = None
+
+# Variant name -> bounding box; derivatives keep the aspect ratio
+VARIANTS = {
+    "thumb": (160, 160),
+    "preview": (1024, 1024),
+}
+FORMAT = "webp"
+MIMETYPE = "image/webp"
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".bmp", ".webp", ".tif", ".tiff"}
+
+
+def available():
+    return Image is not None
+
+
+def is_image(filename):
+    return os.path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS
+
+
+def derivative_path(base_path, variant):
+    """``base_path`` is the content-addressed path the derivative hangs off"""
+    return f"{base_path}-{variant}.{FORMAT}"
+
+
+def render_derivatives(src_path, encoding, base_path):
+    """Write every variant of the image at ``src_path``.
+
+    Returns the list of variants written. It is empty when the file is not
+    an image Pillow can decode.
+    """
+    if Image is None:
+        return []
+    try:
+        with open_stored(src_path, encoding) as f:
+            image = Image.open(f)
+            image = ImageOps.exif_transpose(image)
+            image.load()
+    except (OSError, SyntaxError, ValueError, Image.DecompressionBombError):
+        return []
+
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+
+    os.makedirs(os.path.dirname(base_path), exist_ok=True)
+    written = []
+    for variant, box in VARIANTS.items():
+        copy = image.copy()
+        copy.thumbnail(box, Image.Resampling.LANCZOS)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(base_path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as out:
+            copy.save(out, FORMAT.upper(), quality=80, method=4)
+        os.replace(tmp_path, derivative_path(base_path, variant))
+        written.append(variant)
+    return written